@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# ======================================================================
+
+import pangloss
+
+import sys,getopt,copy,numpy
+
+# ======================================================================
+
+def CheckPrecision(argv):
+    """
+    NAME
+        CheckPrecision.py
+
+    PURPOSE
+        Measure how much computing the lightcones in single precision
+        ("Precision: single") changes the Pr(kappah|D) PDFs, and hence
+        the Pr(kappa_ext|D) that Calibrate.py infers from them.
+
+    COMMENTS
+        The observed lightcone and the first few calibration lightcones
+        are reconstructed twice, in double and in single precision, with
+        the same random numbers, exactly as Reconstruct.py does it. For
+        each one, the shifts in the 16th, 50th and 84th percentiles of
+        Pr(kappah|D) are reported, along with the largest difference
+        between matching samples. The shifts are compared with the width
+        of the PDF, and with the Monte Carlo noise in its median.
+
+        Calibrate.py only uses the median of Pr(kappah|D), smoothed with
+        a Gaussian of width ComparatorWidth, to find Pr(kappa_ext|D) - so
+        if the median shifts are much smaller than ComparatorWidth,
+        single precision leaves Pr(kappa_ext|D) unchanged.
+
+    FLAGS
+        -h            Print this message [0]
+        -n            Number of calibration lightcones to check [10]
+
+    INPUTS
+        configfile    Plain text file containing Pangloss configuration
+
+    OUTPUTS
+        stdout        The comparison, cone by cone, and a summary
+        report        The same, in <CalibrationFolder>/<ExperimentName>_precision_report.txt
+
+    EXAMPLE
+        CheckPrecision.py -n 100 example.config
+
+    BUGS
+
+    AUTHORS
+      This file is part of the Pangloss project, distributed under the
+      GPL v2, by Tom Collett (IoA) and  Phil Marshall (Oxford).
+      Please cite: Collett et al 2013, http://arxiv.org/abs/1303.6564
+
+    HISTORY
+      2026-10-16 started to validate single precision, Pangloss developers
+    """
+
+    # --------------------------------------------------------------------
+
+    try:
+       opts, args = getopt.getopt(argv,"hn:",["help"])
+    except getopt.GetoptError, err:
+       print str(err) # will print something like "option -a not recognized"
+       print CheckPrecision.__doc__  # will print the big comment above.
+       return
+
+    Ncheck = 10
+    for o,a in opts:
+       if o in ("-h", "--help"):
+          print CheckPrecision.__doc__
+          return
+       elif o == "-n":
+          Ncheck = int(a)
+       else:
+          assert False, "unhandled option"
+
+    # Check for setup file in array args:
+    if len(args) == 1:
+        configfile = args[0]
+        print pangloss.doubledashedline
+        print pangloss.hello
+        print pangloss.doubledashedline
+        print "CheckPrecision: comparing single and double precision Pr(kappah|D)"
+        print "CheckPrecision: taking instructions from",configfile
+    else:
+        print CheckPrecision.__doc__
+        return
+
+    # --------------------------------------------------------------------
+    # Read in configuration, and extract the ones we need:
+
+    experiment = pangloss.Configuration(configfile)
+
+    EXP_NAME = experiment.parameters['ExperimentName']
+    CALIB_DIR = experiment.parameters['CalibrationFolder'][0]
+
+    zd = experiment.parameters['StrongLensRedshift']
+    zs = experiment.parameters['SourceRedshift']
+
+    RTscheme = experiment.parameters['RayTracingScheme']
+    SHMrelation = experiment.parameters['StellarMass2HaloMassRelation']
+    HMFfile = experiment.parameters['HMFfile'][0]
+    zperr = experiment.parameters['PhotozError']
+    MserrP = experiment.parameters['PhotometricMstarError']
+    MserrS = experiment.parameters['SpectroscopicMstarError']
+    Ns = experiment.parameters['NRealisations']
+    width = experiment.parameters.get('ComparatorWidth')
+    seed = int(experiment.parameters.get('RandomSeed',0))
+
+    Nc = min(Ncheck,int(experiment.parameters['NCalibrationLightcones']))
+
+    # --------------------------------------------------------------------
+    # Stellar mass to halo mass relation, and the redshift grid:
+
+    # The relation is kept in CALIB_DIR, and only made again if the
+    # method, the HMF catalog or the SHMR code have changed:
+    print "CheckPrecision: getting the stellar mass to halo mass grid."
+    print "CheckPrecision: the first time, this may take a moment..."
+    shmr = pangloss.getSHMR(SHMrelation,HMFfile,CALIB_DIR)
+
+    lookup = (experiment.parameters.get('HaloProfileLookup') == 'True')
+    if lookup:
+        pangloss.getProfileTable("BMO1",CALIB_DIR+'/BMO1_profile_table.pickle')
+
+    grid = pangloss.Grid(zd,zs,nplanes=100)
+
+    # --------------------------------------------------------------------
+    # Read in the lightcones to check:
+
+    names,cones = [],[]
+    if experiment.parameters.get('LightconeFormat') == 'archive':
+        calarchive = pangloss.LightconeArchive(experiment.getLightconeArchiveName('simulated'))
+        for i in range(Nc):
+            names.append('calibration lightcone %i' % i)
+            cones.append(calarchive.read(i))
+    else:
+        # Every cone is kept, so saved ones are read into memory rather
+        # than each holding its file open:
+        for i in range(Nc):
+            names.append('calibration lightcone %i' % i)
+            cones.append(pangloss.readLightcone(experiment.getLightconePickleName('simulated',pointing=i),memmap=False))
+    obspickle = experiment.getLightconePickleName('real')
+    names.append('observed lightcone')
+    cones.append(pangloss.readLightcone(obspickle,memmap=False))
+
+    # --------------------------------------------------------------------
+    # Reconstruct each one twice, with the same random numbers:
+
+    report = []
+    report.append("Single vs double precision Pr(kappah|D), %i samples each" % Ns)
+    report.append("%-26s %10s %10s %10s %10s %10s %10s" % \
+                  ('lightcone','median','width','d16','d50','d84','dmax'))
+
+    shifts,noises,differences = [],[],[]
+    for i in range(len(cones)):
+
+        lc = cones[i]
+        lc.defineSystem(zd,zs)
+        lc.loadGrid(grid)
+        lc.configureForSurvey(experiment)
+
+        samples = []
+        for precision in (numpy.float64,numpy.float32):
+            trial = copy.deepcopy(lc)
+            trial.setPrecision(precision)
+            numpy.random.seed([seed,i])
+            totals = trial.makeRealisations(Ns,grid,shmr,sigmaz=zperr,sigmaP=MserrP,sigmaS=MserrS,\
+                                            errors=True,truncationscale=10,lookup=lookup)
+            if RTscheme == 'sum':
+                samples.append(totals['kappa_add'])
+            elif RTscheme == 'keeton':
+                samples.append(totals['kappa_keeton'])
+            else:
+                raise "Unknown ray-tracing scheme: "+RTscheme
+
+        c = pangloss.comparePDFs(samples[0],samples[1])
+        # The samples pair up, as they were drawn with the same numbers:
+        difference = numpy.abs(samples[1]-samples[0]).max()
+        report.append("%-26s %10.6f %10.6f %10.2e %10.2e %10.2e %10.2e" % \
+                      (names[i],c['a'][1],c['width'],c['shift'][0],c['shift'][1],c['shift'][2],difference))
+
+        shifts.append(numpy.abs(c['shift']).max())
+        # Monte Carlo noise in the median of Ns samples:
+        noises.append(1.253*c['width']/numpy.sqrt(Ns))
+        differences.append(difference)
+
+    # --------------------------------------------------------------------
+    # Summarise:
+
+    shifts,noises = numpy.array(shifts),numpy.array(noises)
+    report.append("Largest percentile shift: %.2e, up to %.2e times the Monte Carlo noise in the median" % \
+                  (shifts.max(),(shifts/noises).max()))
+    report.append("Largest difference between matching samples: %.2e" % max(differences))
+    if width is not None:
+        report.append("Largest percentile shift is %.2e times the ComparatorWidth (%g) used to infer Pr(kappa_ext|D)" % \
+                      (shifts.max()/width,width))
+
+    reportfile = CALIB_DIR+'/'+EXP_NAME+'_precision_report.txt'
+    F = open(reportfile,'w')
+    for line in report:
+        print "CheckPrecision: "+line
+        F.write(line+'\n')
+    F.close()
+    print "CheckPrecision: report saved to "+reportfile
+
+    # --------------------------------------------------------------------
+    print pangloss.doubledashedline
+    return
+
+# ======================================================================
+
+if __name__ == '__main__':
+    CheckPrecision(sys.argv[1:])
+
+# ======================================================================
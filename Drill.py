@@ -3,7 +3,7 @@
 
 import pangloss
 
-import sys,glob,getopt,numpy
+import sys,glob,getopt,numpy,itertools,multiprocessing
 
 from math import pi
 
@@ -28,20 +28,36 @@ def Drill(argv):
         and the true kappa value for each line of sight is also extracted
         and passed on. Lightcone catalogs are stored as pickles.
 
+        With several jobs, each calibration catalog is read in and
+        indexed once, and the processes that drill chunks of its cones
+        share it, rather than each reading their own copy. Streamed
+        catalogs are handed out one per process instead.
+
     FLAGS
         -h            Print this message [0]
+        -b, --batch   Assign galaxies to all calibration lightcones in one
+                      pass over each catalog, instead of one cone at a time
+        -j, --jobs    Number of processes to drill calibration lightcones
+                      with [1]
+        -s, --stream  Read calibration catalogs a chunk at a time, to drill
+                      catalogs that do not fit in memory
 
     INPUTS
         configfile    Plain text file containing Pangloss configuration
 
     OUTPUTS
         stdout        Useful information
-        pickle(s)     Lightcone catalog(s)
+        pickle(s)     Lightcone catalog(s): pickles, or binary files if
+                      LightconeFormat is 'binary' (see Lightcone.save)
 
     EXAMPLE
 
         Drill.py example.config
 
+        Drill.py --batch --jobs 32 example.config
+
+        Drill.py --stream example.config
+
     BUGS
 
     AUTHORS
@@ -56,16 +72,26 @@ def Drill(argv):
     # --------------------------------------------------------------------
 
     try:
-        opts, args = getopt.getopt(argv,"h",["help"])
+        opts, args = getopt.getopt(argv,"hbj:s",["help","batch","jobs=","stream"])
     except getopt.GetoptError, err:
         print str(err) # will print something like "option -a not recognized"
         print Drill.__doc__  # will print the big comment above.
         return
 
+    batch = False
+    stream = False
+    jobs = 1
     for o,a in opts:
         if o in ("-h", "--help"):
             print Drill.__doc__
             return
+        elif o in ("-b", "--batch"):
+            batch = True
+        elif o in ("-j", "--jobs"):
+            jobs = int(a)
+            assert jobs > 0, "need at least one job"
+        elif o in ("-s", "--stream"):
+            stream = True
         else:
             assert False, "unhandled option"
 
@@ -128,63 +154,75 @@ def Drill(argv):
         count = 0
         Ncones = Nc/Ncalcats
 
-        for i,catalog in enumerate(calcats):
-
-            print "Drill: Reading in calibration catalog from "+catalog+"..."
-            table = pangloss.readCatalog(catalog,experiment)
-
-            if units == 'deg':
-                table['nRA'] = -table['nRA'] * pangloss.deg2rad
-                table['Dec'] = table['Dec'] * pangloss.deg2rad
-                table['Mhalo_obs'] = table['Mhalo_obs'] * 1E10
-                table['Mstar_obs'] = table['Mstar_obs'] * 1E10
-            ###
-            #dx = Rc*1.000001*pangloss.arcmin2rad
-            #subtable =table.where((table['pos_0[rad]'] > (-dx)) & \
-            #                      (table['pos_0[rad]'] < (+dx)) & \
-            #                      (table['pos_1[rad]'] > (-dx)) & \
-            #                      (table['pos_1[rad]'] < (+dx))   )
-
-
-            print "Drill: Sampling sky positions in",units,"..."
-            x,y = sample_sky(table,Rc,Ncones,method='random')
-
-            if kappamaps is not None:
-                print "Drill: Reading in kappa map from "+kappamaps[i]
-                MSconvergence = pangloss.Kappamap(kappamaps[i])
-
-            # Coming soon...
-            #   gammafile1 = gamma1[i]
-            #   MSgamma1 = kappamap.Kappamap(gammafile1)
-            #   gammafile2 = gamma2[i]
-            #   MSgamma2 = kappamap.Kappamap(gammafile2)
-
-            print "Drill: Pickling lightcones from this patch of sky..."
-            for k in range(Ncones):
-                if k % 200 == 0 and k !=0:
-                    print ("Drill: ...on cone %i out of %i..." % (k,Ncones))
-
-                lc = pangloss.Lightcone(table,'simulated',[x[k],y[k]],Rc)
-
-                if kappamaps is not None:
-                    lc.kappa_hilbert = MSconvergence.at(x[k],y[k],coordinate_system='physical')
-
-                # Coming soon...
-                #   lc.gamma1_hilbert = MSgamma1.at(x[k],y[k],coordinate_system='physical')
-                #   lc.gamma2_hilbert = MSgamma2.at(x[k],y[k],coordinate_system='physical')
-
-                calpickle = experiment.getLightconePickleName('simulated',pointing=count)
-                pangloss.writePickle(lc,calpickle)
-
-                count += 1
-
-
-            # Save memory!
-            del table
-            del lc
-            del catalog
-
-            print "Drill: ...done."
+        # Each sky patch gets its own random number stream, seeded from
+        # the master seed and the patch number, so that any worker can
+        # reproduce its cone positions:
+        seed = experiment.parameters.get('RandomSeed')
+        if seed is None:
+            seed = numpy.random.randint(2**31-1)
+            print "Drill: No RandomSeed given, using",seed
+        seed = int(seed)
+
+        # Lightcones for an archive come back here, to be written in
+        # pointing order:
+        if experiment.parameters.get('LightconeFormat') == 'archive':
+            calarchive = experiment.getLightconeArchiveName('simulated')
+            archive = pangloss.LightconeArchive(calarchive,mode='w')
+        else:
+            archive = None
+
+        # Streamed catalogs are each read once, in one pass that collects
+        # the galaxies of all their cones, by one process per catalog.
+        # Otherwise, each catalog is read in and indexed once, here, and
+        # its cones are drilled in chunks by processes forked afterwards,
+        # which share the table and index rather than reading their own.
+        # With --batch, the galaxies are assigned to all the catalog's
+        # cones here too, in one sweep, and each chunk of cones just takes
+        # its share of the memberships. Chunks are kept small enough to
+        # hold in memory, for archiving:
+        if stream:
+            groups = [(None,[(experiment,i,0,Ncones,seed,batch,stream) for i in range(Ncalcats)])]
+        else:
+            if jobs > 1:
+                chunksize = max(1,int(numpy.ceil(Ncones/(4.0*jobs))))
+            else:
+                chunksize = max(1,Ncones)
+            chunksize = min(chunksize,1000)
+            groups = []
+            for i in range(Ncalcats):
+                tasks = []
+                for first in range(0,Ncones,chunksize):
+                    last = min(first+chunksize,Ncones)
+                    tasks.append((experiment,i,first,last,seed,batch,stream))
+                groups.append((i,tasks))
+
+        for i,tasks in groups:
+
+            if i is not None: read_sky_patch(experiment,i,seed,batch=batch)
+
+            if jobs > 1 and len(tasks) > 1:
+                print "Drill: Drilling %i chunks of cones with %i processes..." % (len(tasks),jobs)
+                pool = multiprocessing.Pool(min(jobs,len(tasks)))
+                results = pool.imap(drill_calibration_cones,tasks)
+            else:
+                pool = None
+                results = itertools.imap(drill_calibration_cones,tasks)
+
+            for n,lightcones in results:
+                count += n
+                for lc in lightcones:
+                    archive.append(lc)
+
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        # Let go of the last catalog before reading the observed one:
+        patch.clear()
+
+        if archive is not None:
+            archive.close()
+            print "Drill: Calibration lightcones archived in "+calarchive
 
         print ("Drill: All %i calibration lightcones made." % (count))
 
@@ -197,14 +235,16 @@ def Drill(argv):
             print "Drill: Reading in observed catalog: "+obscat
 
             flavor = 'real'
+            storage = experiment.parameters.get('LightconeStorage','arrays')
+            precision = experiment.getPrecision()
 
             table = pangloss.readCatalog(obscat,experiment)
 
             xc = [x0,y0]
-            lc = pangloss.Lightcone(table,'real',xc,Rc)
+            lc = pangloss.Lightcone(table,'real',xc,Rc,storage=storage,dtype=precision)
 
             obspickle = experiment.getLightconePickleName('real')
-            pangloss.writePickle(lc,obspickle)
+            save_lightcone(experiment,lc,obspickle)
 
             print "Drill: Observed lightcone pickled to "+obspickle
 
@@ -214,9 +254,197 @@ def Drill(argv):
     return
 
 # ======================================================================
-# Draw calibration sightlines at random:
+# Drill the calibration cones first,...,last-1 from sky patch i, and pickle
+# them. Pointing numbers depend only on i and k, so the output is the same
+# however the cones are shared between processes. If the lightcones are to
+# be archived, they are returned instead of pickled.
+
+def drill_calibration_cones(task):
 
-def sample_sky(table,Rc,Nc,method='random'):
+    experiment,i,first,last,seed,batch,stream = task
+
+    Rc = experiment.parameters['LightconeRadius'] # in arcmin
+    Ncones = experiment.parameters['NCalibrationLightcones']/len(experiment.parameters['CalibrationCatalogs'])
+
+    table,index,limits,x,y,MSconvergence,membership = read_sky_patch(experiment,i,seed,stream,batch)
+
+    archiving = (experiment.parameters.get('LightconeFormat') == 'archive')
+    storage = experiment.parameters.get('LightconeStorage','arrays')
+    precision = experiment.getPrecision()
+    lightcones = []
+
+    if stream:
+        catalog = experiment.parameters['CalibrationCatalogs'][i]
+        print "Drill: Streaming galaxies into lightcones %i to %i..." % (first,last-1)
+        cones = stream_calibration_cones(experiment,catalog,x[first:last],y[first:last])
+    elif batch:
+        offsets,members = membership
+
+    # Look up the convergence at all the cone centres at once:
+    if MSconvergence is not None:
+        kappas = MSconvergence.at(x[first:last],y[first:last],coordinate_system='physical')
+
+    print "Drill: Drilling lightcones from this patch of sky..."
+    for k in range(first,last):
+        if k % 200 == 0 and k !=0:
+            print ("Drill: ...on cone %i out of %i..." % (k,Ncones))
+
+        if stream:
+            # Each cone's table only holds its own galaxies (if any), so
+            # the limits of the whole catalog are passed on:
+            lc = pangloss.Lightcone(cones[k-first],'simulated',[x[k],y[k]],Rc,limits=limits,storage=storage,dtype=precision)
+            cones[k-first] = None
+        elif batch:
+            rows = members[offsets[k]:offsets[k+1]]
+            lc = pangloss.Lightcone(table,'simulated',[x[k],y[k]],Rc,index=index,rows=rows,storage=storage,dtype=precision)
+        else:
+            lc = pangloss.Lightcone(table,'simulated',[x[k],y[k]],Rc,index=index,storage=storage,dtype=precision)
+
+        if MSconvergence is not None:
+            lc.kappa_hilbert = kappas[k-first]
+
+        # Coming soon...
+        #   lc.gamma1_hilbert = MSgamma1.at(x[k],y[k],coordinate_system='physical')
+        #   lc.gamma2_hilbert = MSgamma2.at(x[k],y[k],coordinate_system='physical')
+
+        if archiving:
+            lightcones.append(lc)
+        else:
+            calpickle = experiment.getLightconePickleName('simulated',pointing=i*Ncones+k)
+            save_lightcone(experiment,lc,calpickle)
+
+    return last-first,lightcones
+
+# ----------------------------------------------------------------------
+# Lightcones are pickled, unless LightconeFormat asks for them to be saved
+# in their own binary format:
+
+def save_lightcone(experiment,lc,filename):
+    if experiment.parameters.get('LightconeFormat') == 'binary':
+        lc.save(filename)
+    else:
+        pangloss.writePickle(lc,filename)
+    return
+
+# ----------------------------------------------------------------------
+# Read in sky patch i: its catalog, index, limits, cone positions and kappa
+# map - and, with batch=True, the galaxies in every one of its cones, as
+# (offsets,members) from assignToCones. The most recent patch is kept:
+# Drill reads each patch in before forking the processes that drill its
+# cones, so that they all share it. When streaming, only the catalog
+# limits are found (from the catalog cache, if there is one), not the
+# catalog itself.
+
+patch = {}
+
+def read_sky_patch(experiment,i,seed,stream=False,batch=False):
+
+    if patch.get('number') == i:
+        return patch['contents']
+    patch.clear()
+
+    Rc = experiment.parameters['LightconeRadius'] # in arcmin
+    Ncones = experiment.parameters['NCalibrationLightcones']/len(experiment.parameters['CalibrationCatalogs'])
+    catalog = experiment.parameters['CalibrationCatalogs'][i]
+    kappamaps = experiment.parameters['CalibrationKappamaps']
+    units = experiment.parameters['Units']
+
+    if stream:
+        print "Drill: Finding the limits of calibration catalog "+catalog+"..."
+        table,index = None,None
+        limits = pangloss.readCatalogLimits(catalog,experiment)
+        xmin,xmax,ymin,ymax = limits
+        corners = {'nRA':numpy.array([xmin,xmax]),'Dec':numpy.array([ymin,ymax])}
+
+    else:
+        print "Drill: Reading in calibration catalog from "+catalog+"..."
+        table = pangloss.readCatalog(catalog,experiment)
+        pangloss.convertCatalogUnits(table,units)
+
+        print "Drill: Indexing galaxy positions..."
+        index = pangloss.SkyIndex(table['nRA'],table['Dec'],Rc*pangloss.arcmin2rad)
+        limits = index.xmin,index.xmax,index.ymin,index.ymax
+        corners = table
+
+    method = experiment.parameters.get('SkySampling','random')
+    separation = experiment.parameters.get('SkySamplingSeparation')
+    print "Drill: Sampling sky positions in",units,"using method",method,"..."
+    rng = numpy.random.RandomState([seed,i])
+    x,y = sample_sky(corners,Rc,Ncones,method=method,rng=rng,separation=separation)
+
+    membership = None
+    if batch and not stream:
+        print "Drill: Assigning galaxies to all %i lightcones..." % Ncones
+        membership = pangloss.assignToCones(table['nRA'],table['Dec'],x,y,Rc)
+
+    MSconvergence = None
+    if kappamaps is not None:
+        print "Drill: Reading in kappa map from "+kappamaps[i]
+        MSconvergence = pangloss.Kappamap(kappamaps[i])
+
+    # Coming soon...
+    #   gammafile1 = gamma1[i]
+    #   MSgamma1 = kappamap.Kappamap(gammafile1)
+    #   gammafile2 = gamma2[i]
+    #   MSgamma2 = kappamap.Kappamap(gammafile2)
+
+    patch['number'] = i
+    patch['contents'] = table,index,limits,x,y,MSconvergence,membership
+
+    return patch['contents']
+
+# ----------------------------------------------------------------------
+# Make one pass over a catalog that is too big to read in, collecting the
+# galaxies that fall in each of the given cones. Returns one table per
+# cone, so memory use is set by the lightcones, not the catalog. Chunks
+# parsed straight from the text can differ in their column types, so every
+# cone's columns (even an empty cone's) are given the widest type seen.
+
+def stream_calibration_cones(experiment,catalog,x,y):
+
+    Rc = experiment.parameters['LightconeRadius'] # in arcmin
+
+    pieces = [[] for k in range(len(x))]
+    names,dtypes,kind = None,{},None
+    for chunk in pangloss.readCatalogChunks(catalog,experiment):
+        if names is None: names,kind = list(chunk.keys()),chunk.__class__
+        for name in names:
+            dtype = numpy.asarray(chunk[name]).dtype
+            dtypes[name] = numpy.promote_types(dtypes.get(name,dtype),dtype)
+        offsets,members = pangloss.assignToCones(chunk['nRA'],chunk['Dec'],x,y,Rc)
+        for k in numpy.where(offsets[1:] > offsets[:-1])[0]:
+            rows = members[offsets[k]:offsets[k+1]]
+            pieces[k].append(dict([(name,numpy.asarray(chunk[name])[rows]) for name in names]))
+
+    # A new table (of the same kind as the chunks) for each cone, a column
+    # at a time, so the table keeps its own books on its columns:
+    cones = []
+    for k in range(len(x)):
+        cone = kind()
+        for name in names:
+            values = [piece[name] for piece in pieces[k]]
+            if len(values) == 0:
+                cone.add_column(name,numpy.zeros(0,dtype=dtypes[name]))
+            else:
+                cone.add_column(name,numpy.concatenate(values).astype(dtypes[name]))
+        pieces[k] = None
+        cones.append(cone)
+
+    return cones
+
+# ======================================================================
+# Draw calibration sightlines, keeping them Rc away from the catalog edges.
+# Methods:
+#   'random'      uniformly at random - cones can overlap
+#   'grid'        centres of Nc cells of a regular grid
+#   'stratified'  one random position in each of Nc cells of a grid
+#   'poisson'     at random, but no closer than separation (arcmin,
+#                 default 2*Rc, so that the cones do not overlap)
+# Grid cells are chosen at random when Nc does not fill the grid. All the
+# random numbers come from rng, so a seeded RandomState gives the same
+# sightlines every time.
+
+def sample_sky(table,Rc,Nc,method='random',rng=numpy.random,separation=None):
 
     xmax = table['nRA'].max()
     xmin = table['nRA'].min()
@@ -224,14 +452,101 @@ def sample_sky(table,Rc,Nc,method='random'):
     ymin = table['Dec'].min()
 
     Rcrad = Rc*pangloss.arcmin2rad
+    x0,x1,y0,y1 = xmin+Rcrad,xmax-Rcrad,ymin+Rcrad,ymax-Rcrad
 
     if method == 'random':
-        x = numpy.random.uniform(xmin+Rcrad,xmax-Rcrad,Nc)
-        y = numpy.random.uniform(ymin+Rcrad,ymax-Rcrad,Nc)
+        x = rng.uniform(x0,x1,Nc)
+        y = rng.uniform(y0,y1,Nc)
+
+    elif method == 'grid' or method == 'stratified':
+        # Cells as close to square as possible, at least Nc of them:
+        width,height = x1-x0,y1-y0
+        nx = max(1,int(numpy.ceil(numpy.sqrt(Nc*width/height))))
+        ny = int(numpy.ceil(Nc/float(nx)))
+        cells = numpy.sort(rng.permutation(nx*ny)[:Nc])
+        i,j = cells % nx, cells // nx
+        if method == 'grid':
+            x = x0 + (i+0.5)*width/nx
+            y = y0 + (j+0.5)*height/ny
+        else:
+            x = x0 + (i+rng.uniform(0.0,1.0,Nc))*width/nx
+            y = y0 + (j+rng.uniform(0.0,1.0,Nc))*height/ny
+
+    elif method == 'poisson':
+        if separation is None: separation = 2.0*Rc
+        x,y = poisson_disk(x0,x1,y0,y1,Nc,separation*pangloss.arcmin2rad,rng)
+
     else:
-        assert False
+        raise ValueError("Drill: unknown sky sampling method "+str(method))
+
     return x,y
 
+# ----------------------------------------------------------------------
+# Dart throwing, a batch of darts at a time. A grid of cells of side
+# dmin/sqrt(2) holds at most one accepted point each, so any point closer
+# than dmin to a dart is in the 5x5 cells around it. Only one dart per
+# cell is kept, and darts too close to an earlier dart in the same batch
+# are thrown away.
+
+def poisson_disk(x0,x1,y0,y1,Nc,dmin,rng,patience=100):
+
+    a = dmin/numpy.sqrt(2.0)
+    nx = int(numpy.ceil((x1-x0)/a))
+    ny = int(numpy.ceil((y1-y0)/a))
+    # Pad by 2 cells, so the 5x5 stencil never leaves the grid. Cells are
+    # numbered along Dec first:
+    grid = -numpy.ones((nx+4)*(ny+4),dtype=int)
+    darts = -numpy.ones((nx+4)*(ny+4),dtype=int)
+    stencil = [di*(ny+4)+dj for di in range(-2,3) for dj in range(-2,3)]
+
+    x,y = numpy.zeros(Nc),numpy.zeros(Nc)
+    n,misses = 0,0
+    while n < Nc:
+
+        M = max(2*(Nc-n),nx*ny//8,1000)
+        dx = rng.uniform(x0,x1,M)
+        dy = rng.uniform(y0,y1,M)
+        ix = numpy.minimum(((dx-x0)/a).astype(int),nx-1) + 2
+        iy = numpy.minimum(((dy-y0)/a).astype(int),ny-1) + 2
+        cell = ix*(ny+4) + iy
+
+        # One dart (the last) in each empty cell:
+        darts[cell] = numpy.arange(M)
+        first = (darts[cell] == numpy.arange(M)) & (grid[cell] < 0)
+        darts[cell] = -1
+        dx,dy,cell = dx[first],dy[first],cell[first]
+        number = numpy.arange(len(dx))
+
+        ok = numpy.ones(len(dx),dtype=bool)
+        darts[cell] = number
+        for offset in stencil:
+            # Points accepted before:
+            k = grid[cell+offset]
+            near = (k >= 0)
+            d2 = (x[k]-dx)**2 + (y[k]-dy)**2
+            ok &= ~(near & (d2 < dmin*dmin))
+            # Earlier darts in this batch:
+            k = darts[cell+offset]
+            near = (k >= 0) & (k < number)
+            d2 = (dx[k]-dx)**2 + (dy[k]-dy)**2
+            ok &= ~(near & (d2 < dmin*dmin))
+        darts[cell] = -1
+
+        keep = numpy.where(ok)[0][:Nc-n]
+        if len(keep) == 0:
+            misses += 1
+            if misses > patience:
+                raise ValueError("Drill: cannot fit %i sightlines %.2f arcmin apart, only %i" \
+                                     % (Nc,dmin*pangloss.rad2arcmin,n))
+            continue
+        misses = 0
+
+        x[n:n+len(keep)] = dx[keep]
+        y[n:n+len(keep)] = dy[keep]
+        grid[cell[keep]] = numpy.arange(n,n+len(keep))
+        n += len(keep)
+
+    return x,y
 
 # ======================================================================
 
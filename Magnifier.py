@@ -139,9 +139,19 @@ def Magnifier(argv):
     calpickles = []
     Nc = experiment.parameters['NCalibrationLightcones'] * Ncats       ### should be 24
 
-    paths = '%s/*_lightcone.pickle' % (CALIB_DIR)
-    found = glob.glob(paths)
-    if len(found) > 0: calpickles = found
+    if experiment.parameters.get('LightconeFormat') == 'archive':
+        calarchive = pangloss.LightconeArchive(experiment.getLightconeArchiveName('simulated'))
+        calpickles = [experiment.getLightconePickleName('simulated',pointing=i) for i in range(len(calarchive))]
+        readcone = calarchive.read
+    else:
+        paths = '%s/*_lightcone.pickle' % (CALIB_DIR)
+        if experiment.parameters.get('LightconeFormat') == 'binary':
+            paths = '%s/*_lightcone.bin' % (CALIB_DIR)
+        found = glob.glob(paths)
+        if len(found) > 0: calpickles = found
+        # Every cone is kept, so saved ones are read into memory rather
+        # than each holding its file open:
+        readcone = lambda i: pangloss.readLightcone(calpickles[i],memmap=False)
 
     print "Magnifier: found the lightcones..."
            
@@ -162,7 +172,7 @@ def Magnifier(argv):
     calcones = []
 
     for i in xrange(Nc):         
-       calcones.append(pangloss.readPickle(calpickles[i]))
+       calcones.append(readcone(i))
        if i==0: print calpickles[i]
 
     if DoCal=="False": #must be string type
@@ -183,7 +193,7 @@ def Magnifier(argv):
 
     # Sort into lightcones for each field
     for i in xrange(Nc): 
-       lc = pangloss.readPickle(calpickles[i])  
+       lc = readcone(i)
        num_galaxies = lc.numberWithin(radius=Rc,cut=[16,22],band=mag,units="arcmin")
        lc_galaxies.append(num_galaxies)   
        # Add to the total number of galaxies
@@ -230,7 +240,7 @@ def Magnifier(argv):
     for j in xrange(Nc):        
 
         # Get lightcone
-        lc = pangloss.readPickle(calpickles[j])
+        lc = readcone(j)
 
         # --------------------------------------------------------------------
         # Calculate mu and kappa for all lightcones
@@ -261,9 +271,8 @@ def Magnifier(argv):
         pk.append(lc.kappa_add_total)
 
         if plot_contributions is True:
-            kappa_cont[j:,] = lc.findContributions('kappa')   
-            Mh_cont[j:,] = lc.findContributions('mass') 
-            Mstell_cont[j:,] = lc.findContributions('stellarmass') 
+            kappa_cont[j:,],Mh_cont[j:,],Mstell_cont[j:,] = \
+                lc.findContributions(['kappa','mass','stellarmass'])
            
         # Make a nice visualisation of one of the lightcones
         if j ==0:
@@ -3,7 +3,7 @@
 
 import pangloss
 
-import sys,getopt,cPickle,numpy
+import sys,getopt,cPickle,numpy,multiprocessing,itertools
 
 # ======================================================================
 
@@ -28,8 +28,34 @@ def Reconstruct(argv):
         The number of kappah samples desired must also be given in the
         config file.
 
+        A manifest of the lightcones already reconstructed, and the
+        outputs they made, is kept in
+        <CalibrationFolder>/<ExperimentName>_reconstruct_manifest.pickle
+        (and, until the run finishes, a .journal of the lightcones done
+        since it started). A restarted run skips every lightcone whose outputs are intact
+        and were made from the same lightcone file, with the same
+        configuration (apart from the parameters that only Calibrate.py
+        uses, or that choose which lightcones to reconstruct). Each
+        lightcone has its own random number stream, so the outputs are
+        the same as if the run had never stopped. If the config gives no
+        RandomSeed, the seed chosen by the first run is kept in the
+        manifest, and used again by the runs that resume it (but not by
+        --fresh ones).
+
+        Lightcones are read one at a time, as they are needed: with one
+        job, the next lightcone is read in a background thread while the
+        current one is reconstructed. Memory use does not grow with the
+        number of lightcones.
+
     FLAGS
         -h            Print this message [0]
+        -f, --fresh   Reconstruct all the lightcones, even those the
+                      manifest says are already done [0]
+        -j, --jobs    Number of processes to reconstruct lightcones with
+                      [1]; the samples are the same however many are used
+        -p            Write the lightcone plots from a background
+                      process, so that reconstruction carries on while
+                      they are drawn [0]
 
     INPUTS
         configfile    Plain text file containing Pangloss configuration
@@ -40,6 +66,9 @@ def Reconstruct(argv):
 
     EXAMPLE
         Reconstruct.py example.config
+        Reconstruct.py -p example.config
+        Reconstruct.py --jobs 8 example.config
+        Reconstruct.py --fresh example.config
 
     BUGS
         - Code is incomplete.
@@ -56,16 +85,26 @@ def Reconstruct(argv):
     # --------------------------------------------------------------------
 
     try:
-       opts, args = getopt.getopt(argv,"h",["help"])
+       opts, args = getopt.getopt(argv,"hfj:p",["help","fresh","jobs=","background-plots"])
     except getopt.GetoptError, err:
        print str(err) # will print something like "option -a not recognized"
        print Reconstruct.__doc__  # will print the big comment above.
        return
 
+    background = False
+    fresh = False
+    jobs = 1
     for o,a in opts:
        if o in ("-h", "--help"):
           print Reconstruct.__doc__
           return
+       elif o in ("-f", "--fresh"):
+          fresh = True
+       elif o in ("-j", "--jobs"):
+          jobs = int(a)
+          assert jobs > 0, "need at least one job"
+       elif o in ("-p", "--background-plots"):
+          background = True
        else:
           assert False, "unhandled option"
 
@@ -86,6 +125,14 @@ def Reconstruct(argv):
     
     experiment = pangloss.Configuration(configfile)
 
+    # Start the plotting process now, while this one is still small. With
+    # several jobs, each one draws its own plots:
+    if background and jobs == 1:
+        plotter = multiprocessing.Pool(1)
+        print "Reconstruct: lightcone plots will be written in the background"
+    else:
+        background = False
+
     # Get the experiment name from the configfile name instead?
     EXP_NAME = experiment.parameters['ExperimentName']
 
@@ -99,158 +146,303 @@ def Reconstruct(argv):
     
     obspickle = experiment.getLightconePickleName('real')
     
-    # Ray tracing:
-    RTscheme = experiment.parameters['RayTracingScheme']
-    
     # SHM relation parameters:
     SHMrelation = experiment.parameters['StellarMass2HaloMassRelation']
     CALIB_DIR = experiment.parameters['CalibrationFolder'][0]
-    SHMfile = CALIB_DIR+'/'+SHMrelation+'.pickle'
     
     # Halo mass function data:
     HMFfile = experiment.parameters['HMFfile'][0]
     
-    # Photo-zs:
-    zperr = experiment.parameters['PhotozError']
-    
-    # Stellar mass observations:
-    MserrP = experiment.parameters['PhotometricMstarError']
-    MserrS = experiment.parameters['SpectroscopicMstarError']
-    # Sampling Pr(kappah|D):
-    Ns = experiment.parameters['NRealisations']
-    
     # Reconstruct calibration lines of sight?
     DoCal = experiment.parameters['ReconstructCalibrations']
 
+    # Single or double precision lightcones and PDFs:
+    precision = experiment.getPrecision()
+
     # --------------------------------------------------------------------
     # Load in stellar mass to halo relation, or make a new one:
 
-    try:
-        shmr = pangloss.readPickle('dummy')#SHMfile)
-    except IOError:
-        print "Reconstruct: generating the stellar mass to halo mass grid."
-        print "Reconstruct: this may take a moment..."
-        shmr = pangloss.SHMR(method=SHMrelation)
-        shmr.makeHaloMassFunction(HMFfile)
-        shmr.makeCDFs()
-        pangloss.writePickle(shmr,SHMfile)
-        print "Reconstruct: SHMR saved to "+SHMfile
+    # The relation is kept in CALIB_DIR, and only made again if the
+    # method, the HMF catalog or the SHMR code have changed:
+    print "Reconstruct: getting the stellar mass to halo mass grid."
+    print "Reconstruct: the first time, this may take a moment..."
+    shmr = pangloss.getSHMR(SHMrelation,HMFfile,CALIB_DIR)
     
+    # --------------------------------------------------------------------
+    # Halo profiles can be looked up in a table, instead of computed from
+    # the formulae - make it, or read it in:
+
+    lookup = (experiment.parameters.get('HaloProfileLookup') == 'True')
+    if lookup:
+        pangloss.getProfileTable("BMO1",CALIB_DIR+'/BMO1_profile_table.pickle')
+
     # --------------------------------------------------------------------
     # Make redshift grid:
     
     grid = pangloss.Grid(zd,zs,nplanes=100)
     
     # --------------------------------------------------------------------
-    # Read in lightcones from pickles:
+    # List the lightcones to reconstruct: calibration cones come from
+    # pickles, or from the calibration archive:
 
-    calcones = []
-    for i in range(Nc):
-        calcones.append(pangloss.readPickle(calpickles[i]))
-    obscone = pangloss.readPickle(obspickle)
+    if experiment.parameters.get('LightconeFormat') == 'archive':
+        calarchive = experiment.getLightconeArchiveName('simulated')
+    else:
+        calarchive = None
 
-    if DoCal=="False": #must be string type
-        calcones=[]
-        calpickles=[]
+    alltasks = []
+    if DoCal != "False": #must be string type
+        for i in range(Nc):
+            alltasks.append(('simulated',i,calpickles[i],calarchive))
+    alltasks.append(('real',0,obspickle,None))
 
-    allcones = calcones+[obscone]
-    allconefiles = calpickles+[obspickle]
+    # --------------------------------------------------------------------
+    # Skip the lightcones already reconstructed with this configuration.
+    # Parameters that cannot change any one lightcone's outputs are left
+    # out of the configuration hash:
+
+    ignore = ['NCalibrationLightcones','ReconstructCalibrations',
+              'MakeNewCalibrations','Comparator','ComparatorType',
+              'ComparatorWidth','CalibrateMode']
+    manifest = pangloss.Manifest(CALIB_DIR+'/'+EXP_NAME+'_reconstruct_manifest.pickle',
+                                 experiment.getHash(ignore=ignore))
+    if fresh: manifest.forget()
+
+    # Each lightcone gets its own random number stream, seeded from the
+    # master seed and its pointing number, so that the samples do not
+    # depend on how many processes share the work. A seed chosen at
+    # random is remembered in the manifest, so that a resumed run carries
+    # on with the same one:
+
+    seed = experiment.parameters.get('RandomSeed')
+    if seed is None:
+        seed = manifest.recall('RandomSeed')
+        if seed is None:
+            seed = numpy.random.randint(2**31-1)
+            manifest.remember('RandomSeed',seed)
+            print "Reconstruct: No RandomSeed given, using",seed
+        else:
+            print "Reconstruct: No RandomSeed given, carrying on with",seed,"from the manifest"
+    seed = int(seed)
+
+    tasks,inputs = [],{}
+    for task in alltasks:
+        flavor,i,conefile,calarchive = task
+        if calarchive is not None:
+            inputs[conefile] = [calarchive]
+        else:
+            inputs[conefile] = [conefile]
+        if not manifest.done(conefile,inputs[conefile]):
+            tasks.append(task)
+
+    if len(tasks) < len(alltasks):
+        print "Reconstruct: %i of %i lightcones already reconstructed, according to" % \
+              (len(alltasks)-len(tasks),len(alltasks))
+        print "Reconstruct:   "+manifest.filename
 
     # --------------------------------------------------------------------
-    # Make realisations of each lightcone, and store sample kappah vals:
-
-    for i in range(len(allcones)):
-
-        print pangloss.dashedline
-        print "Reconstruct: drawing %i samples from Pr(kappah|D)" % (Ns)
-        print "Reconstruct:   given data in "+allconefiles[i]
-
-        # Get lightcone, and start PDF for its kappa_halo:
-        lc = allcones[i]
-        p = pangloss.PDF('kappa_halo')
-        # coming soon: gamma1, gamma2...
-
-        # Redshift scaffolding:
-        lc.defineSystem(zd,zs)
-        lc.loadGrid(grid)
-
-        # Figure out data quality etc:
-        lc.configureForSurvey(experiment)
-
-        # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
-
-        # Draw Ns sample realisations of this lightcone, and hence
-        # accumulate samples from Pr(kappah|D):
-        for j in range(Ns):
-
-            if j % 20 == 0 and j !=0:
-                print ("Reconstruct: ...on sample %i out of %i..." % (j,Ns))
-
-            # Draw z from z_obs:
-            lc.mimicPhotozError(sigma=zperr)
-            lc.snapToGrid(grid)
-            
-            # Simulated lightcones need mock observed Mstar_obs values 
-            # drawing from their Mhalos:
-            if lc.flavor == 'simulated': lc.drawMstars(shmr)
-            
-            # Draw Mstar from Mstar_obs:
-            lc.mimicMstarError(sigmaP=MserrP,sigmaS=MserrS)
-
-            # Draw Mhalo from Mstar, and then c from Mhalo:
-            lc.drawMhalos(shmr)
-            lc.drawConcentrations(errors=True)
-
-            # Compute each halo's contribution to the convergence:
-            lc.makeKappas(truncationscale=10)
-            
-            k_add=lc.combineKappas()
-
-            if RTscheme == 'sum':
-                p.append([lc.kappa_add_total])
-                # coming soon: lc.gamma1_add_total, lc.gamma2_add_total
-            elif RTscheme == 'keeton':
-                p.append([lc.kappa_keeton])
-            else:
-                raise "Unknown ray-tracing scheme: "+RTscheme
-            
-            # Make a nice visualisation of one of the realisations, in
-            # two example cases:
-            if j ==0 and (lc.flavor == 'real' or i == 0):
-                x = allconefiles[i]
-                pngfile = x.split('.')[0]+".png"
-                lc.plot(output=pngfile)
-                print "Reconstruct: saved visualisation of lightcone in "+pngfile
-        
-        # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
+    # Make realisations of each lightcone, and store sample kappah vals,
+    # noting each one in the manifest as it is finished:
+
+    # Worker processes get the SHMR and grid tables as read-only shared
+    # memory, rather than copies of their own. (The plotter, forked
+    # earlier, never uses them.)
+    if jobs > 1:
+        shmr.share()
+        grid.share()
+
+    shared = {'experiment':experiment,'grid':grid,'shmr':shmr,'lookup':lookup,
+              'precision':precision,'seed':seed,'plotter':None,'plots':[]}
+
+    if jobs > 1:
+        print "Reconstruct: Reconstructing %i lightcones with %i processes..." % (len(tasks),jobs)
+        pool = multiprocessing.Pool(jobs,initializer=share,initargs=(shared,))
+        # The workers have the shared tables mapped now, so their files
+        # can go - and a run that is killed leaves nothing behind:
+        pangloss.unlinkSharedArrays()
+        results = pool.imap_unordered(read_and_reconstruct_lightcone,tasks)
+    else:
+        # Read each lightcone in a background thread while the one
+        # before it is being reconstructed, holding at most one in
+        # waiting - so only a couple are ever in memory at once:
+        pool = None
+        if background: shared['plotter'] = plotter
+        share(shared)
+        cones = pangloss.prefetch(itertools.imap(read_lightcone,tasks),depth=1)
+        results = itertools.starmap(reconstruct_lightcone,cones)
+
+    for conefile,outputs in results:
+        manifest.record(conefile,inputs[conefile],outputs)
+    manifest.save()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
+    # --------------------------------------------------------------------
+    # Wait for any plots still being drawn:
 
+    if background:
+        plotter.close()
+        plotter.join()
+        for plot in shared['plots']:
+            print "Reconstruct: saved visualisation of lightcone in "+plot.get()
 
-        # Take Hilbert ray-traced kappa for this lightcone as "truth":
-        p.truth[0] = lc.kappa_hilbert
-        
-        # Pickle this lightcone's PDF:
-        x = allconefiles[i]
-        pfile = x.split('.')[0].split("_lightcone")[0]+"_"+EXP_NAME+"_PofKappah.pickle"
-        pangloss.writePickle(p,pfile)
+    # --------------------------------------------------------------------
+    print pangloss.doubledashedline
+    return
 
-        print "Reconstruct: Pr(kappah|D) saved to "+pfile
-        
-        # To save loading in time in Calibrate.py we compute the median
-        # of kappah and save it in a separate file, with kappaHilbert
-        if lc.flavor=="simulated":
-            pfile2 = x.split('.')[0].split("_lightcone")[0]+"_"+EXP_NAME+"_KappaHilbert_Kappah_median.pickle"
-            pangloss.writePickle([p.truth[0],[numpy.median(p.samples)]],pfile2)
+# ======================================================================
+# Everything the lightcones have in common (the configuration, grid, SHMR
+# and so on) is handed to each worker process once, when it starts.
 
-            # BUG: shouldn't Pr(kappa,<kappah>) be pickled as a PDF?
-            # BUG: and named appropriately? 
-            # No, this is just a pair of values
+shared = {}
 
-        #print numpy.median(p.samples)
-    # --------------------------------------------------------------------
-    print pangloss.doubledashedline
+def share(contents):
+    shared.clear()
+    shared.update(contents)
     return
 
+# ----------------------------------------------------------------------
+# Read the lightcone for one task, which is (flavor,pointing,lightcone
+# file,calibration archive name). Lightcones are only ever read one at a
+# time, as they are needed:
+
+def read_lightcone(task):
+
+    flavor,i,conefile,calarchive = task
+
+    if calarchive is not None:
+        if shared.get('archive') is None:
+            shared['archive'] = pangloss.LightconeArchive(calarchive)
+        lc = shared['archive'].read(i)
+    else:
+        lc = pangloss.readLightcone(conefile)
+
+    return task,lc
+
+def read_and_reconstruct_lightcone(task):
+    return reconstruct_lightcone(*read_lightcone(task))
+
+# ----------------------------------------------------------------------
+# Draw samples from Pr(kappah|D) for one lightcone, and pickle them. The
+# lightcone file name and the list of output files are returned. The
+# calibration lightcone at pointing i uses random number stream
+# [seed,1,i], and the observed lightcone uses [seed,2,0].
+
+def reconstruct_lightcone(task,lc):
+
+    flavor,i,conefile,calarchive = task
+
+    experiment = shared['experiment']
+    grid,shmr = shared['grid'],shared['shmr']
+    lookup,precision = shared['lookup'],shared['precision']
+
+    # Get the experiment name from the configfile name instead?
+    EXP_NAME = experiment.parameters['ExperimentName']
+    zd = experiment.parameters['StrongLensRedshift']
+    zs = experiment.parameters['SourceRedshift']
+    RTscheme = experiment.parameters['RayTracingScheme']
+    zperr = experiment.parameters['PhotozError']
+    MserrP = experiment.parameters['PhotometricMstarError']
+    MserrS = experiment.parameters['SpectroscopicMstarError']
+    Ns = experiment.parameters['NRealisations']
+
+    print pangloss.dashedline
+    print "Reconstruct: drawing %i samples from Pr(kappah|D)" % (Ns)
+    print "Reconstruct:   given data in "+conefile
+
+    # Start PDF for the lightcone's kappa_halo:
+    lc.setPrecision(precision)
+    p = pangloss.PDF('kappa_halo',dtype=precision)
+    # coming soon: gamma1, gamma2...
+
+    if flavor == 'real':
+        numpy.random.seed([shared['seed'],2,0])
+    else:
+        numpy.random.seed([shared['seed'],1,i])
+
+    # Redshift scaffolding:
+    lc.defineSystem(zd,zs)
+    lc.loadGrid(grid)
+
+    # Figure out data quality etc:
+    lc.configureForSurvey(experiment)
+
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
+
+    # Draw Ns sample realisations of this lightcone, all at once, and
+    # hence accumulate samples from Pr(kappah|D):
+    totals = lc.makeRealisations(Ns,grid,shmr,sigmaz=zperr,sigmaP=MserrP,sigmaS=MserrS,\
+                                 errors=True,truncationscale=10,lookup=lookup)
+
+    if RTscheme == 'sum':
+        p.append(totals['kappa_add'].reshape(Ns,1))
+        # coming soon: gamma1_add, gamma2_add
+    elif RTscheme == 'keeton':
+        p.append(totals['kappa_keeton'].reshape(Ns,1))
+    else:
+        raise "Unknown ray-tracing scheme: "+RTscheme
+
+    # Make a nice visualisation of one more realisation, in two
+    # example cases - this needs the galaxy table filling in, so is
+    # done one step at a time:
+    if lc.flavor == 'real' or i == 0:
+
+        # Draw z from z_obs:
+        lc.mimicPhotozError(sigma=zperr)
+        lc.snapToGrid(grid)
+        
+        # Simulated lightcones need mock observed Mstar_obs values 
+        # drawing from their Mhalos:
+        if lc.flavor == 'simulated': lc.drawMstars(shmr)
+        
+        # Draw Mstar from Mstar_obs:
+        lc.mimicMstarError(sigmaP=MserrP,sigmaS=MserrS)
+
+        # Draw Mhalo from Mstar, and then c from Mhalo:
+        lc.drawMhalos(shmr)
+        lc.drawConcentrations(errors=True)
+
+        # Compute each halo's contribution to the convergence:
+        lc.makeKappas(truncationscale=10,lookup=lookup)
+        lc.combineKappas()
+
+        x = conefile
+        pngfile = x.split('.')[0]+".png"
+        if shared['plotter'] is not None:
+            shared['plots'].append(shared['plotter'].apply_async(pangloss.plotLightcone,(lc,pngfile)))
+            print "Reconstruct: visualisation of lightcone will be saved in "+pngfile
+        else:
+            lc.plot(output=pngfile)
+            print "Reconstruct: saved visualisation of lightcone in "+pngfile
+    
+    # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
+
+    # Take Hilbert ray-traced kappa for this lightcone as "truth":
+    p.truth[0] = lc.kappa_hilbert
+    
+    # Pickle this lightcone's PDF:
+    x = conefile
+    pfile = x.split('.')[0].split("_lightcone")[0]+"_"+EXP_NAME+"_PofKappah.pickle"
+    pangloss.writePickle(p,pfile)
+
+    print "Reconstruct: Pr(kappah|D) saved to "+pfile
+    outputs = [pfile]
+    
+    # To save loading in time in Calibrate.py we compute the median
+    # of kappah and save it in a separate file, with kappaHilbert
+    if lc.flavor=="simulated":
+        pfile2 = x.split('.')[0].split("_lightcone")[0]+"_"+EXP_NAME+"_KappaHilbert_Kappah_median.pickle"
+        pangloss.writePickle([p.truth[0],[numpy.median(p.samples)]],pfile2)
+        outputs.append(pfile2)
+
+        # BUG: shouldn't Pr(kappa,<kappah>) be pickled as a PDF?
+        # BUG: and named appropriately? 
+        # No, this is just a pair of values
+
+    return conefile,outputs
+
 # ======================================================================
 
 if __name__ == '__main__': 
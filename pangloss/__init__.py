@@ -1,11 +1,16 @@
 from lightcone import *
+from galaxytable import *
 from kappamap import *
 from grid import *
 from pdf import *
 from shmr import *
+from skyindex import *
+from sharedarray import *
 
 from config import *
 from io import *
+from archive import *
+from manifest import *
 
 from lensing import *
 from scalingrelations import *
@@ -0,0 +1,325 @@
+# ===========================================================================
+
+import pangloss
+
+import os,cPickle,numpy
+
+# ============================================================================
+
+class LightconeArchive(object):
+    """
+    NAME
+        LightconeArchive
+
+    PURPOSE
+        Store many lightcones in one file: the galaxies of all the cones
+        are concatenated into one array per column, with per-cone row
+        offsets and metadata (centre, radius, kappa_hilbert etc) kept in
+        a small header. Any one cone can be read back by its index
+        without unpickling the others.
+
+    COMMENTS
+        File layout: a magic string and format version, the length of
+        the header, the pickled header, and then the column arrays, each
+        starting on a 64-byte boundary. The file is mapped into memory
+        (once: each column is a view of the one map, so an open archive
+        holds one file descriptor), and only the rows of the requested
+        cone are touched. With memmap=False, the columns are read into
+        memory instead, and the file is closed straight away - for
+        anyone keeping thousands of single-cone files open at once.
+
+        The header holds only plain Python values: the column layout,
+        the cone offsets, and a short list of each cone's scalar
+        metadata (see metadata below). Anything else a lightcone has
+        picked up (grid arrays, profile tables and so on) is left out,
+        and is remade when the lightcone is next put through its paces.
+
+        While writing, each column is spooled to its own scratch file
+        next to the archive (or, with spool=False, kept in memory);
+        close() assembles the archive and renames it into place, so a
+        half-written archive never looks complete.
+
+        An archive of just one cone is how Lightcone.save stores a single
+        lightcone, and pangloss.readLightcone reads it back.
+
+        Cones are stored in the order they are appended: Drill appends
+        them in pointing order, so index = pointing number.
+
+        The file is mapped once, when the archive is opened, and the
+        cones read from it are read-only slices of that map: reading
+        any number of cones costs no more file descriptors or mappings.
+        A GalaxyTable copies a read-only column the first time it is
+        written to.
+
+    INITIALISATION
+        filename      Name of archive file
+        mode          'r' to read an existing archive, 'w' to write one
+        spool         Spool columns to scratch files while writing, rather
+                      than keeping them in memory [True]
+        memmap        Map the columns, rather than reading them into
+                      memory, when reading [True]
+
+    METHODS
+        append(self,lc): add a lightcone to the end of the archive. Its
+            columns must have the same names and types as the first
+            lightcone's, or ValueError is raised
+
+        close(self): finish writing the archive
+
+        read(self,k): return lightcone number k, with its galaxies in a
+            GalaxyTable
+
+        columns(self,k): return dictionary of cone k's galaxy columns
+
+    BUGS
+
+    AUTHORS
+      This file is part of the Pangloss project, distributed under the
+      GPL v2, by Tom Collett (IoA) and  Phil Marshall (Oxford).
+      Please cite: Collett et al 2013, http://arxiv.org/abs/1303.6564
+
+    HISTORY
+      2026-10-16  started to replace one pickle per pointing, Pangloss developers
+    """
+
+    magic = 'PANGLOSS-LIGHTCONES'
+    version = 1
+    align = 64
+
+    # The lightcone attributes kept in the header:
+    metadata = ('name','flavor','kappa_hilbert','dtype','rmax','xc',
+                'xmax','xmin','ymax','ymin','zl','zs','cosmo')
+
+# ----------------------------------------------------------------------------
+
+    def __init__(self,filename,mode='r',spool=True,memmap=True):
+
+        self.name = 'Archive of lightcones'
+        self.filename = filename
+        self.mode = mode
+        self.memmap = memmap
+
+        if mode == 'w':
+            self.names = None
+            self.dtypes = None
+            self.offsets = [0]
+            self.cones = []
+            self.spooling = spool
+            self.spool = {}
+        elif mode == 'r':
+            self.open()
+        else:
+            raise ValueError("LightconeArchive: unknown mode "+mode)
+
+        return None
+
+# ----------------------------------------------------------------------------
+
+    def __str__(self):
+        return 'Archive of %i lightcones in %s' % (len(self),self.filename)
+
+    def __len__(self):
+        return len(self.offsets)-1
+
+    def __getitem__(self,k):
+        return self.read(k)
+
+# ----------------------------------------------------------------------------
+# Writing:
+
+    def append(self,lc):
+
+        assert self.mode == 'w'
+        galaxies = lc.galaxies
+        names = list(galaxies.keys())
+
+        # The first cone fixes the columns and their types:
+        if self.names is None:
+            self.names = names
+            self.dtypes = [numpy.asarray(galaxies[name]).dtype for name in names]
+            for i,name in enumerate(names):
+                if self.spooling:
+                    self.spool[name] = open(self.spoolname(i),'wb')
+                else:
+                    self.spool[name] = []
+        assert names == self.names, \
+            "LightconeArchive: all lightcones must have the same columns"
+
+        # ...and the same types, since casting to the first cone's types
+        # could truncate strings or lose precision without a word:
+        columns = [numpy.asarray(galaxies[name]) for name in names]
+        for name,dtype,values in zip(self.names,self.dtypes,columns):
+            if values.dtype != dtype:
+                raise ValueError("LightconeArchive: column %s of lightcone %i is %s, not %s like the first lightcone's" \
+                                     % (name,len(self),values.dtype,dtype))
+
+        for name,values in zip(self.names,columns):
+            if self.spooling:
+                values.tofile(self.spool[name])
+            else:
+                self.spool[name].append(values)
+
+        meta = {}
+        for key in self.metadata:
+            if hasattr(lc,key):
+                meta[key] = plainValue(getattr(lc,key))
+        self.cones.append(meta)
+        self.offsets.append(self.offsets[-1]+len(galaxies))
+
+        return
+
+    def spoolname(self,i):
+        return self.filename+'.column_%03i.tmp' % i
+
+    def close(self):
+
+        if self.mode != 'w': return
+        self.mode = 'closed'
+
+        nrows = self.offsets[-1]
+        names = self.names
+        if names is None: names,self.dtypes = [],[]
+
+        # Lay out the columns, relative to the start of the data:
+        columns,start = [],0
+        for name,dtype in zip(names,self.dtypes):
+            columns.append((name,dtype.str,start))
+            start += nrows*dtype.itemsize
+            start += (-start) % self.align
+
+        header = {'version':self.version,
+                  'columns':columns,
+                  'offsets':plainValue(self.offsets),
+                  'cones':self.cones}
+        header = cPickle.dumps(header,protocol=2)
+
+        scratch = self.filename+'.tmp'
+        F = open(scratch,'wb')
+        F.write(self.magic)
+        F.write(numpy.array([self.version,len(header)],dtype='<i8').tostring())
+        F.write(header)
+        F.write('\0' * ((-F.tell()) % self.align))
+        for i,name in enumerate(names):
+            if self.spooling:
+                self.spool[name].close()
+                S = open(self.spoolname(i),'rb')
+                block = S.read(2**24)
+                while len(block) > 0:
+                    F.write(block)
+                    block = S.read(2**24)
+                S.close()
+                pangloss.rm(self.spoolname(i))
+            else:
+                for values in self.spool[name]:
+                    values.tofile(F)
+            F.write('\0' * ((-F.tell()) % self.align))
+        F.close()
+        os.rename(scratch,self.filename)
+
+        return
+
+# ----------------------------------------------------------------------------
+# Reading:
+
+    def open(self):
+
+        F = open(self.filename,'rb')
+        magic = F.read(len(self.magic))
+        if magic != self.magic:
+            raise IOError("LightconeArchive: "+self.filename+" is not a lightcone archive")
+        version,length = numpy.fromstring(F.read(16),dtype='<i8')
+        if version > self.version:
+            raise IOError("LightconeArchive: "+self.filename+" was written by a newer version of Pangloss")
+        header = cPickle.loads(F.read(length))
+        F.close()
+
+        datastart = len(self.magic) + 16 + length
+        datastart += (-datastart) % self.align
+
+        # Archives written before the header was kept plain hold an
+        # array of offsets already:
+        self.offsets = numpy.asarray(header['offsets'],dtype=numpy.int64)
+        self.cones = header['cones']
+        nrows = self.offsets[-1]
+
+        # The whole file is mapped once, and each column is a view of its
+        # own stretch of that map:
+        self.names,self.data,self.starts = [],{},{}
+        if nrows > 0:
+            if self.memmap:
+                whole = numpy.memmap(self.filename,dtype=numpy.uint8,mode='r')
+            else:
+                F = open(self.filename,'rb')
+        for name,dtype,start in header['columns']:
+            self.names.append(name)
+            self.starts[name] = datastart+start
+            dtype = numpy.dtype(dtype)
+            if nrows == 0:
+                self.data[name] = numpy.zeros(0,dtype=dtype)
+            elif self.memmap:
+                first = datastart+start
+                self.data[name] = whole[first:first+nrows*dtype.itemsize].view(dtype)
+            else:
+                F.seek(datastart+start)
+                self.data[name] = numpy.fromfile(F,dtype=dtype,count=nrows)
+        if nrows > 0 and not self.memmap: F.close()
+
+        # Handy per-cone arrays, for looking at the ensemble:
+        self.centres = numpy.array([cone['xc'] for cone in self.cones])
+        self.radii = numpy.array([cone['rmax'] for cone in self.cones])
+        self.kappa_hilbert = numpy.array([cone.get('kappa_hilbert') for cone in self.cones])
+
+        return
+
+    def columns(self,k):
+        first,last = self.offsets[k],self.offsets[k+1]
+        return dict([(name,self.data[name][first:last]) for name in self.names])
+
+    def read(self,k):
+
+        # The columns are read-only slices of the archive's own maps, so
+        # nothing is copied (or opened) until the lightcone writes to them:
+        galaxies = pangloss.GalaxyTable()
+        first,last = self.offsets[k],self.offsets[k+1]
+        for name in self.names:
+            values = self.data[name][first:last].view(numpy.ndarray)
+            galaxies.add_column(name,values,copy=False)
+
+        # Restore the lightcone just as unpickling would, without calling
+        # __init__ (which needs the parent catalog). Older archives may
+        # hold more than the metadata, which is ignored:
+        lc = object.__new__(pangloss.Lightcone)
+        for key in self.metadata:
+            if key in self.cones[k]:
+                setattr(lc,key,self.cones[k][key])
+        if getattr(lc,'dtype',None) is not None:
+            lc.dtype = numpy.dtype(lc.dtype)
+        lc.galaxies = galaxies
+        lc.allgalaxies = galaxies
+
+        return lc
+
+# ============================================================================
+# Header values are kept as plain Python numbers, strings and lists, so
+# that reading the header never needs numpy's (or anyone's) classes:
+
+def plainValue(value):
+    if isinstance(value,numpy.dtype):
+        return value.str
+    if isinstance(value,numpy.generic):
+        return value.item()
+    if isinstance(value,(list,tuple,numpy.ndarray)):
+        return [plainValue(item) for item in value]
+    return value
+
+# ============================================================================
+# Is this file a lightcone archive (rather than, say, a pickle)? Only the
+# magic string at the start is read.
+
+def isLightconeArchive(filename):
+    F = open(filename,'rb')
+    magic = F.read(len(LightconeArchive.magic))
+    F.close()
+    return (magic == LightconeArchive.magic)
+
+# ============================================================================
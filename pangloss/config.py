@@ -1,6 +1,8 @@
 # ===========================================================================
 
-import os, glob
+import pangloss
+
+import os, glob, hashlib, numpy
 
 # ======================================================================
 
@@ -25,7 +27,21 @@ class Configuration(object):
         
         prepare(self): set up workspace
         
-        getLightconePickleName(self,flavor,pointing=None): 
+        getLightconePickleName(self,flavor,pointing=None): ends in .bin
+            rather than .pickle if LightconeFormat is 'binary'
+
+        getLightconeArchiveName(self,flavor): one file for all the
+            lightcones of this flavor, if LightconeFormat is 'archive'
+
+        getCatalogColumns(self): names of the catalog columns to read in,
+            or None for all of them
+
+        getPrecision(self): numpy floating point type for the lightcone
+            galaxies and the PDFs: float64, or float32 if Precision is
+            'single'
+
+        getHash(self,ignore=[]): hex digest of the parameter values,
+            leaving out those named in ignore
 
     BUGS
 
@@ -38,6 +54,10 @@ class Configuration(object):
       2013-03-23  Collett & Marshall (Cambridge)
     """
 
+    # Parameters holding paths, which can have wildcards in them:
+    pathkeys = ['CalibrationCatalogs', 'CalibrationKappamaps',
+                'ObservedCatalog', 'CalibrationFolder', 'HMFfile']
+
     def __init__(self,configfile):
         self.file = configfile
         self.parameters = {}
@@ -83,14 +103,15 @@ class Configuration(object):
 
         # Now sort out filenames etc:
 
-        pathkeys = ['CalibrationCatalogs', 'CalibrationKappamaps',
-                    'ObservedCatalog', 'CalibrationFolder', 'HMFfile']
-        for key in pathkeys:
+        for key in self.pathkeys:
             paths = self.parameters[key]
             # Expand environment variables (eg $PANGLOSS_DIR)
             paths = os.path.expandvars(paths)
             # Expand wildcards - glob returns [] if no files found...
             found = glob.glob(paths)
+            # ...and only catalogs and maps, not eg their cache folders:
+            if key in ['CalibrationCatalogs','CalibrationKappamaps']:
+                found = [path for path in found if os.path.isfile(path)]
             if len(found) > 0: paths = found
             # Make sure all paths are lists, for consistency:
             if len(paths[0]) == 1: paths = [paths]
@@ -127,21 +148,27 @@ class Configuration(object):
         return
 
     # ------------------------------------------------------------------
-    # Figure out pickle names:
+    # Figure out pickle names (or, for lightcones saved by Lightcone.save,
+    # binary file names):
 
     def getLightconePickleName(self,flavor,pointing=None):
 
+        if self.parameters.get('LightconeFormat') == 'binary':
+            extension = ".bin"
+        else:
+            extension = ".pickle"
+
         if flavor == 'real':
             # In this case, need the name of the obscat:
             x = self.parameters['ObservedCatalog'][0]
-            return x.split('.')[0]+"_lightcone.pickle"
+            return x.split('.')[0]+"_lightcone"+extension
         
         elif flavor == 'simulated':
             # In this case, need the CALIB_DIR and pointing number:
             assert pointing != None
             CALIB_DIR = self.parameters['CalibrationFolder'][0]          
             x = "%s/pointing_%i" % (CALIB_DIR, pointing)
-            return x+"_lightcone.pickle"
+            return x+"_lightcone"+extension
 
         elif flavor == 'simulated_borg':
             # In this case, need the CALIB_DIR and pointing number:
@@ -152,7 +179,81 @@ class Configuration(object):
             EXP_NAME = self.parameters['ExperimentName']            
             x = "%s/%s_pointing_%i" % (CALIB_DIR, EXP_NAME, pointing)
 
-            return x+"_lightcone.pickle"
+            return x+"_lightcone"+extension
+
+        return
+
+    # ------------------------------------------------------------------
+    # Which catalog columns are needed? By default, just the ones the
+    # pipeline uses (after renaming); "CatalogColumns: all" keeps them
+    # all, and a list like "CatalogColumns: [GalID,mag_SDSS_r]" keeps
+    # those as well as the required ones.
+
+    def getCatalogColumns(self):
+
+        choice = self.parameters.get('CatalogColumns','required')
+        if choice == 'all': return None
+
+        columns = ['nRA','Dec','z_obs','Mhalo_obs','Mstar_obs','Type',
+                   self.parameters['MagName'],
+                   pangloss.magnitudeColumn(self.parameters['LightconeDepthBand'])]
+
+        if choice != 'required':
+            extras = str(choice).strip('[]').split(',')
+            columns += [extra for extra in extras if extra != '']
+
+        return columns
+
+    # ------------------------------------------------------------------
+    # Lightcones and PDFs are computed in double precision, unless
+    # "Precision: single" asks for float32 (half the memory):
+
+    def getPrecision(self):
+
+        choice = self.parameters.get('Precision','double')
+        if choice == 'double':
+            return numpy.float64
+        elif choice == 'single':
+            return numpy.float32
+        else:
+            raise ValueError("Configuration: Precision must be 'single' or 'double', not "+str(choice))
+
+    # ------------------------------------------------------------------
+    # Fingerprint of the configuration, to tell whether outputs made
+    # earlier were made with the same settings. Parameters that cannot
+    # change the outputs in question can be left out. Wildcards expand to
+    # files in whatever order the filesystem lists them, so the path lists
+    # are sorted first - the same configuration hashes the same anywhere:
+
+    def getHash(self,ignore=[]):
+
+        md5 = hashlib.md5()
+        for key in sorted(self.parameters.keys()):
+            if key in ignore: continue
+            value = self.parameters[key]
+            if key in self.pathkeys and isinstance(value,list):
+                value = sorted(value)
+            md5.update(repr((key,value)))
+
+        return md5.hexdigest()
+
+    # ------------------------------------------------------------------
+    # Figure out archive names, for when all the lightcones are kept in
+    # one LightconeArchive file instead of one pickle per pointing:
+
+    def getLightconeArchiveName(self,flavor):
+
+        if flavor == 'real':
+            # In this case, need the name of the obscat:
+            x = self.parameters['ObservedCatalog'][0]
+            return x.split('.')[0]+"_lightcones.archive"
+
+        elif flavor == 'simulated' or flavor == 'simulated_borg':
+            # In this case, need the CALIB_DIR and experiment name:
+            CALIB_DIR = self.parameters['CalibrationFolder'][0]
+            EXP_NAME = self.parameters['ExperimentName']
+            x = "%s/%s" % (CALIB_DIR, EXP_NAME)
+            return x+"_lightcones.archive"
 
         return
 
@@ -0,0 +1,191 @@
+# ===========================================================================
+
+import pangloss
+
+import numpy
+
+# ============================================================================
+
+class GalaxyTable(object):
+    """
+    NAME
+        GalaxyTable
+
+    PURPOSE
+        Hold the galaxies of a lightcone as one plain numpy array per
+        column, with just enough of the atpy Table interface for the
+        Lightcone methods to use it in place of one.
+
+    COMMENTS
+        An atpy Table keeps its columns in one structured array, so
+        adding a column means reallocating and copying the whole table.
+        Here a new column costs one array of its own, and writing to an
+        existing column (as every realisation of a lightcone does)
+        overwrites it in place, casting to the column's type just as
+        atpy does. The only new memory a realisation needs is whatever
+        scratch arrays it computes along the way.
+
+        Columns are got with table['name'] or table.name, and the arrays
+        returned are the columns themselves, not copies - so
+        table.flag[mask] = True changes the table. where() and rows()
+        return new tables with copied columns.
+
+        Columns can be read-only views of someone else's memory (eg of a
+        LightconeArchive's memory maps). Writing to one with table[name]
+        = values, or to writeable(name), first swaps it for a copy.
+
+    INITIALISATION
+        table         Table to copy the columns of: anything with keys()
+                      and __getitem__, like an atpy Table [None]
+
+    METHODS
+        keys(self): column names, in the order they were added
+
+        add_column(self,name,values,copy=True): add a new column
+
+        writeable(self,name): the column, copied first if it is read-only
+
+        remove_columns(self,names): drop some columns
+
+        where(self,mask): new table of the rows where mask is True
+
+        rows(self,ids): new table of the given rows
+
+        data: the table as one numpy structured array (a copy)
+
+    BUGS
+
+    AUTHORS
+      This file is part of the Pangloss project, distributed under the
+      GPL v2, by Tom Collett (IoA) and  Phil Marshall (Oxford).
+      Please cite: Collett et al 2013, http://arxiv.org/abs/1303.6564
+
+    HISTORY
+      2026-10-16  written to stop realisations copying tables, Pangloss developers
+    """
+
+    __slots__ = ('names','columns','nrows')
+
+# ----------------------------------------------------------------------------
+
+    def __init__(self,table=None):
+
+        self.names = []
+        self.columns = {}
+        self.nrows = 0
+
+        if table is not None:
+            for name in table.keys():
+                self.add_column(name,table[name])
+
+        return None
+
+# ----------------------------------------------------------------------------
+
+    def __str__(self):
+        return 'Table of %i galaxies, with %i columns' % (self.nrows,len(self.names))
+
+    def __len__(self):
+        return self.nrows
+
+# ----------------------------------------------------------------------------
+# Columns are available as attributes, like in atpy. Special names are left
+# alone, so that copying and pickling don't come here looking for them.
+
+    def __getattr__(self,name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        try:
+            return object.__getattribute__(self,'columns')[name]
+        except (KeyError,AttributeError):
+            raise AttributeError(name)
+
+    def __getitem__(self,item):
+        if isinstance(item,basestring):
+            return self.columns[item]
+        return self.data[item]
+
+# Writing to an existing column overwrites it in place:
+
+    def __setitem__(self,name,values):
+        if name not in self.columns:
+            raise ValueError("Column %s does not exist" % name)
+        self.writeable(name)[...] = values
+        return
+
+# ----------------------------------------------------------------------------
+
+    def __getstate__(self):
+        return self.names,self.columns,self.nrows
+
+    def __setstate__(self,state):
+        self.names,self.columns,self.nrows = state
+        return
+
+# ----------------------------------------------------------------------------
+
+    def keys(self):
+        return tuple(self.names)
+
+    def add_column(self,name,values,copy=True):
+
+        if name in self.columns:
+            raise ValueError("Column %s already exists" % name)
+
+        values = numpy.array(values,copy=copy)
+        if len(self.names) == 0 and values.ndim > 0:
+            self.nrows = len(values)
+        # Single values fill the whole column:
+        if values.ndim == 0:
+            values = numpy.repeat(values,self.nrows)
+        if len(values) != self.nrows:
+            raise ValueError("Column %s has %i rows, not %i" % (name,len(values),self.nrows))
+
+        self.names.append(name)
+        self.columns[name] = values
+
+        return
+
+    def writeable(self,name):
+        values = self.columns[name]
+        if not values.flags.writeable:
+            values = numpy.array(values)
+            self.columns[name] = values
+        return values
+
+    def remove_columns(self,names):
+        if isinstance(names,basestring): names = [names]
+        for name in names:
+            self.names.remove(name)
+            del self.columns[name]
+        return
+
+# ----------------------------------------------------------------------------
+# Selections make new tables, so they never share memory with this one:
+
+    def where(self,mask):
+        return self.rows(numpy.where(mask)[0])
+
+    def rows(self,ids):
+
+        ids = numpy.asarray(ids,dtype=int)
+        selection = GalaxyTable()
+        selection.nrows = len(ids)
+        for name in self.names:
+            selection.names.append(name)
+            selection.columns[name] = self.columns[name][ids]
+
+        return selection
+
+# ----------------------------------------------------------------------------
+
+    def get_data(self):
+        dtype = [(name,self.columns[name].dtype) for name in self.names]
+        data = numpy.empty(self.nrows,dtype=dtype)
+        for name in self.names:
+            data[name] = self.columns[name]
+        return data
+
+    data = property(get_data)
+
+# ============================================================================
@@ -28,6 +28,9 @@ class Grid():
 
     METHODS
         snap(self,z): Return redshift of nearest plane to z
+
+        share(self): Move the per-plane arrays into shared memory, for
+            worker processes to use without copying
     
     BUGS
 
@@ -99,6 +102,13 @@ class Grid():
         snapped_z = self.redshifts[snapped_p]
         return snapped_z,snapped_p
 
+# ---------------------------------------------------------------------------
+
+    def share(self):
+        for name in ('redshifts','Da_p','rho_crit','Da_ps','Da_pl','sigma_crit','beta'):
+            setattr(self,name,pangloss.shareArray(getattr(self,name)))
+        return
+
 # ---------------------------------------------------------------------------
 
     def __str__(self):
@@ -2,7 +2,7 @@
 
 import pangloss
 
-import os,cPickle,atpy
+import os,sys,shutil,hashlib,cPickle,threading,Queue,itertools,atpy,numpy
 
 # ======================================================================
 
@@ -14,17 +14,80 @@ import os,cPickle,atpy
         Useful general functions to streamline file input and output.
 
     COMMENTS
+        writePickle writes to a scratch file and renames it into place,
+        so a pickle is either complete or not there at all - a job that
+        dies part way through never leaves a truncated one behind.
+
+        readCatalog keeps a binary copy of each ASCII catalog it reads, in
+        a hidden directory called .<catalog>.cache next to it (hidden, so
+        that the CalibrationCatalogs wildcards don't pick it up) - set
+        "CatalogCache: False" in the config file to switch this off.
+        Only the catalog columns that the pipeline needs are kept (see
+        Configuration.getCatalogColumns), unless "CatalogColumns: all"
+        is set.
 
     FUNCTIONS
         writePickle(contents,filename):
 
         readPickle(filename): returns contents of pickle
 
-        readCatalog(filename,config): returns table, given column names
-                                      in configuration config
+        readLightcone(filename,memmap=True): returns lightcone saved by
+                                      Lightcone.save (memory-mapped, unless
+                                      memmap=False), or pickled by
+                                      writePickle
+
+        prefetch(items,depth=2): yields items from an iterable (eg a
+                                      generator that reads lightcones),
+                                      got ready in a background thread
+
+        readCatalog(filename,config,columns=None): returns table, given
+                                      column names in configuration config;
+                                      only the columns needed are kept
+
+        getCatalogRenames(config): list of (old,new) column name pairs
+
+        readCatalogCache(filename,renames): columns from binary cache,
+                                      or None if it is missing or stale
+
+        readCatalogCacheManifest(filename,renames): the cache's manifest,
+                                      or None if it is missing or stale
+
+        readCatalogLimits(filename,config): (xmin,xmax,ymin,ymax) of the
+                                      catalog positions, from the cache
+                                      if possible
+
+        readCatalogChunks(filename,config,chunksize=1000000,columns=None):
+                                      yields tables of consecutive rows
+
+        convertCatalogUnits(table,units): deg -> rad etc, in place
+
+        readAsciiHeader(filename): column names of a text catalog
+
+        readAsciiChunks(filename,chunksize=1000000): yields structured
+                                      arrays of consecutive rows
+
+        parseAsciiChunks(lines,chunksize=1000000): same, from an
+                                      iterable of lines
+
+        parseAsciiLines(lines,names): structured array from lines
+
+        asciiChunksAgree(filename,nlines=1000): does readAsciiChunks
+                                      read this catalog as atpy does?
+
+        renameColumns(names,renames): list of names after renames
+
+        makeCatalogCache(filename,renames,chunksize=1000000): make binary
+                                      cache a chunk at a time, widening
+                                      column types as later chunks need
+
+        md5sum(filename): hex digest of file contents
+
+        stamp(filename): (size,mtime) of file, or None if it is missing
 
         rm(filename): silent file removal
 
+        rmdir(dirname): silent directory removal
+
     BUGS
 
     AUTHORS
@@ -39,9 +102,15 @@ import os,cPickle,atpy
 #=========================================================================
 
 def writePickle(contents,filename):
-    F = open(filename,"wb")
-    cPickle.dump(contents,F,protocol=2)
-    F.close()
+    scratch = filename+'.%i.tmp' % os.getpid()
+    try:
+        F = open(scratch,"wb")
+        cPickle.dump(contents,F,protocol=2)
+        F.close()
+        os.rename(scratch,filename)
+    except:
+        rm(scratch)
+        raise
     return
 
 def readPickle(filename):
@@ -51,65 +120,515 @@ def readPickle(filename):
     return contents
 
 # ----------------------------------------------------------------------------
+# Lightcones saved by Lightcone.save are one-cone LightconeArchives; older
+# lightcones are pickles. Either can be read, whatever the file is called.
+# Saved lightcones are memory-mapped, so their columns are not copied until
+# they are written to; each one holds its file open (one descriptor) while
+# it is in use. Anyone keeping many lightcones at once can ask for them to
+# be read into memory instead, with memmap=False.
+
+def readLightcone(filename,memmap=True):
+    if pangloss.isLightconeArchive(filename):
+        archive = pangloss.LightconeArchive(filename,memmap=memmap)
+        if len(archive) != 1:
+            raise IOError("readLightcone: "+filename+" holds %i lightcones, not 1" % len(archive))
+        return archive.read(0)
+    return readPickle(filename)
+
+# ----------------------------------------------------------------------------
+# Read ahead: yield the items of an iterable while a background thread gets
+# the next ones ready, so that (eg) the next lightcone is read in while
+# this one is being worked on. At most depth items are held waiting. Any
+# exception raised by the iterable is raised again here, in the caller's
+# thread. Waiting for the disk doesn't hold the GIL, so reading files
+# overlaps with the caller's work; unpickling mostly does, so it overlaps
+# less.
+
+def prefetch(items,depth=2):
+
+    queue = Queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    # Give up waiting for room in the queue if the caller has stopped:
+    def put(message):
+        while not stopped.is_set():
+            try:
+                queue.put(message,timeout=0.1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in items:
+                if not put(('item',item)): return
+            put(('done',None))
+        except:
+            put(('error',sys.exc_info()))
+        return
+
+    thread = threading.Thread(target=produce)
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            # A timeout keeps Ctrl-C working while we wait:
+            try:
+                kind,value = queue.get(timeout=0.1)
+            except Queue.Empty:
+                continue
+            if kind == 'item':
+                yield value
+            elif kind == 'done':
+                break
+            else:
+                raise value[0],value[1],value[2]
+    finally:
+        stopped.set()
 
-def readCatalog(filename,config):
+    return
 
-# PJM: we need to switch to astropy tables...
-# Here's how Richard McMahon uses them, admittedly when reading in FITS:
+# ----------------------------------------------------------------------------
 
-"""
-here is an example; I like to write out the version number to help with debugging.
+def readCatalog(filename,config,columns=None):
+
+    # PJM: we need to switch to astropy tables...
+    # Here's how Richard McMahon uses them, admittedly when reading in FITS:
+    #
+    #   import astropy
+    #   print('astropy: ', astropy.version)
+    #   from astropy.table import Table
+    #   from astropy.io import fits
+    #
+    #   infile_OM10="/home/rgm/soft/OM10/OM10/data/qso_mock.fits"
+    #   table=Table.read(infile_OM10)
+    #   table.pprint()
+    #   print 'colnames: ', table.colnames
+    #   print 'meta: ', table.meta
+    #
+    #   # see http://astropy.readthedocs.org/en/latest/table/modify_table.html
+    #   # to see how to add a column, e.g. before the first table column:
+    #   table.add_column(aa, index=0)
+    #   table.write('new.fits')
+
+    # Parsing a big ASCII catalog is slow, so by default we keep a binary
+    # copy of it (one .npy file per column, renamed according to the
+    # config) and read that instead whenever it is still up to date:
+    usecache = (str(config.parameters.get('CatalogCache','True')) != 'False')
+
+    renames = getCatalogRenames(config)
+
+    # Only keep the columns we need - by default, the ones the config
+    # asks for:
+    if columns is None:
+        columns = config.getCatalogColumns()
+
+    # The cache keeps all the columns, so any selection can use it. It is
+    # made by the same parser whether the catalog is read whole or in
+    # chunks, so both see the same column types:
+    cached = None
+    if usecache:
+        cached = readCatalogCache(filename,renames)
+        if cached is None:
+            makeCatalogCache(filename,renames)
+            cached = readCatalogCache(filename,renames)
+
+    if cached is None:
+        table = atpy.Table(filename, type='ascii')
+        for old,new in renames:
+            try: table.rename_column(old,new)
+            except: pass
+        if columns is not None:
+            table.keep_columns([name for name in table.keys() if name in columns])
+    else:
+        table = atpy.Table()
+        for name,values in cached:
+            if columns is None or name in columns:
+                table.add_column(name,values)
+
+    try:
+        mag = table[config.parameters['MagName']]
+        table.add_column('mag',mag)
+    except:
+        raise "Error in io.readCatalog: no mag column called "+config.parameters['MagName']
 
-import astropy
-print('astropy: ', astropy.version)
-from astropy.table import Table
-from astropy.io import fits
+    return table
 
-infile_OM10="/home/rgm/soft/OM10/OM10/data/qso_mock.fits"
-print 'Read in with Astropy FITS table reader'
-table=Table.read(infile_OM10)
-table.pprint()
-print 'Numer of rows: ', len(table)
-print 'columns: ', table.columns
+# ----------------------------------------------------------------------------
+# The column renames asked for in the config, in the order they are tried:
+
+def getCatalogRenames(config):
+    renames = []
+    keys = [('nRAName','nRA'),
+            ('DecName','Dec'),
+            # Calibration catalogs:
+            ('CalibMhaloName','Mhalo_obs'),
+            ('CalibRedshiftName','z_obs'),
+            # Observed catalog:
+            ('ObsMstarName','Mstar_obs'),
+            ('ObsRedshiftName','z_obs')]
+    for key,new in keys:
+        if key in config.parameters:
+            renames.append((str(config.parameters[key]),new))
+    return renames
 
-print 'colnames: ', table.colnames
-print 'meta: ', table.meta
+# ----------------------------------------------------------------------------
+# Binary catalog cache: a hidden directory next to the catalog (so that
+# wildcards like catalog*.* can't match it), holding one .npy file per
+# column and a small manifest pickle. The manifest records the
+# size, mtime and md5 hash of the ASCII file it was made from, the
+# column renames that were applied, and the range of the nRA and Dec
+# columns (as they are in the file, before any change of units).
 
-# see http://astropy.readthedocs.org/en/latest/table/modify_table.html
-# to see how to add a column, e.g.
-# to insert before the first table column, do:
+def getCatalogCacheName(filename):
+    folder,catalog = os.path.split(filename)
+    return os.path.join(folder,'.'+catalog+'.cache')
 
-table.add_column(aa, index=0)
+def readCatalogCacheManifest(filename,renames):
 
-table.write('new.fits')
+    manifestfile = getCatalogCacheName(filename)+'/manifest.pickle'
+    try:
+        manifest = readPickle(manifestfile)
+    except (IOError,EOFError,cPickle.UnpicklingError):
+        return None
 
-"""
+    if manifest['renames'] != renames: return None
 
-    table = atpy.Table(filename, type='ascii')
+    # Cheap check first - if the file looks different, look at its contents:
+    stat = os.stat(filename)
+    if manifest['size'] != stat.st_size: return None
+    if manifest['mtime'] != stat.st_mtime:
+        if manifest['md5'] != md5sum(filename): return None
+        # Same contents, just touched. Remember the new mtime:
+        manifest['mtime'] = stat.st_mtime
+        try: writePickle(manifest,manifestfile)
+        except IOError: pass
 
-    try: table.rename_column(config.parameters['nRAName'],'nRA')
-    except: pass
-    try: table.rename_column(config.parameters['DecName'],'Dec')
-    except: pass
+    return manifest
 
-    # Calibration catalogs:
-    try: table.rename_column(config.parameters['CalibMhaloName'],'Mhalo_obs')
-    except: pass
-    try: table.rename_column(config.parameters['CalibRedshiftName'],'z_obs')
-    except: pass
+def readCatalogCache(filename,renames):
+
+    manifest = readCatalogCacheManifest(filename,renames)
+    if manifest is None: return None
+
+    cachedir = getCatalogCacheName(filename)
+    columns = []
+    for name,columnfile in manifest['columns']:
+        try:
+            values = numpy.load(cachedir+'/'+columnfile,mmap_mode='r')
+        except (IOError,ValueError):
+            # Missing, or cut short while being written:
+            return None
+        columns.append((name,values))
+
+    return columns
+
+# ----------------------------------------------------------------------------
+# Catalogs too big to hold in memory can be read a chunk of rows at a time.
+# Each chunk is a table holding just the requested columns (by default, the
+# ones the config asks for), with the renames and unit conversions that the
+# config asks for already done. Chunks are read from the binary cache,
+# which is made first if necessary - a chunk at a time, too.
+
+def readCatalogChunks(filename,config,chunksize=1000000,columns=None):
+
+    if columns is None:
+        columns = config.getCatalogColumns()
+
+    usecache = (str(config.parameters.get('CatalogCache','True')) != 'False')
+
+    renames = getCatalogRenames(config)
+    units = config.parameters.get('Units')
+    magname = config.parameters.get('MagName')
+
+    cached = None
+    if usecache:
+        cached = readCatalogCache(filename,renames)
+        if cached is None:
+            makeCatalogCache(filename,renames,chunksize)
+            cached = readCatalogCache(filename,renames)
+
+    if cached is not None:
+        names = [name for name,values in cached]
+        nrows = len(cached[0][1])
+        def source():
+            for first in range(0,nrows,chunksize):
+                yield [values[first:first+chunksize] for name,values in cached]
+    elif asciiChunksAgree(filename):
+        # No cache to be had - parse the text as we go:
+        names = renameColumns(readAsciiHeader(filename),renames)
+        def source():
+            for data in readAsciiChunks(filename,chunksize):
+                yield [data[name] for name in data.dtype.names]
+    else:
+        # Only atpy can read this catalog, and only all at once:
+        whole = atpy.Table(filename, type='ascii')
+        names = renameColumns(whole.keys(),renames)
+        def source():
+            for first in range(0,len(whole),chunksize):
+                yield [whole[name][first:first+chunksize] for name in whole.keys()]
+
+    for chunk in source():
+        table = atpy.Table()
+        for name,values in zip(names,chunk):
+            if columns is None or name in columns or name == magname:
+                table.add_column(name,numpy.array(values))
+        if magname in names:
+            table.add_column('mag',table[magname])
+            if columns is not None and magname not in columns:
+                table.remove_columns([magname])
+        convertCatalogUnits(table,units)
+        yield table
+
+    return
+
+# ----------------------------------------------------------------------------
+# The limits (xmin,xmax,ymin,ymax) of a catalog's positions, in the units
+# used in Pangloss. The binary cache notes the range of the positions when
+# it is made, so with a cache (made first, if necessary) the catalog need
+# not be read at all; otherwise it takes one pass over the nRA and Dec
+# columns, a chunk at a time.
+
+def readCatalogLimits(filename,config,chunksize=1000000):
+
+    usecache = (str(config.parameters.get('CatalogCache','True')) != 'False')
+    renames = getCatalogRenames(config)
+
+    ranges = None
+    if usecache:
+        manifest = readCatalogCacheManifest(filename,renames)
+        if manifest is None:
+            makeCatalogCache(filename,renames,chunksize)
+            manifest = readCatalogCacheManifest(filename,renames)
+        if manifest is not None:
+            ranges = manifest.get('ranges')
+
+    if ranges is not None:
+        corners = atpy.Table()
+        for name in ['nRA','Dec']:
+            corners.add_column(name,numpy.array(ranges[name],dtype=float))
+        convertCatalogUnits(corners,config.parameters.get('Units'))
+        chunks = [corners]
+    else:
+        chunks = readCatalogChunks(filename,config,chunksize,columns=['nRA','Dec'])
+
+    xmin,xmax,ymin,ymax = numpy.inf,-numpy.inf,numpy.inf,-numpy.inf
+    for chunk in chunks:
+        if len(chunk) == 0: continue
+        xmin,xmax = min(xmin,chunk['nRA'].min()),max(xmax,chunk['nRA'].max())
+        ymin,ymax = min(ymin,chunk['Dec'].min()),max(ymax,chunk['Dec'].max())
+
+    return xmin,xmax,ymin,ymax
+
+# ----------------------------------------------------------------------------
+# Some catalogs come in degrees and units of 10^10 solar masses. Convert
+# them to the nRA = -RA (rad), Dec (rad) and solar mass units used in
+# Pangloss, in place:
+
+def convertCatalogUnits(table,units):
+    if units == 'deg':
+        names = table.keys()
+        if 'nRA' in names: table['nRA'] *= -pangloss.deg2rad
+        if 'Dec' in names: table['Dec'] *= pangloss.deg2rad
+        if 'Mhalo_obs' in names: table['Mhalo_obs'] *= 1E10
+        if 'Mstar_obs' in names: table['Mstar_obs'] *= 1E10
+    return
+
+# ----------------------------------------------------------------------------
+# Plain text catalogs, read a chunk at a time. The first line holds the
+# column names (possibly after a '#'); other lines starting with '#' are
+# comments. The types of the columns are inferred afresh for each chunk,
+# so a column of integers in one chunk can be floats in the next: anything
+# that puts chunks together has to allow for that (see makeCatalogCache).
+# Only whitespace-separated columns are understood: catalogs laid out any
+# other way (commas, fixed widths, a header commented out...) have to be
+# read by atpy, and asciiChunksAgree tells which is which.
+
+def readAsciiHeader(filename):
+    F = open(filename)
+    line = F.readline()
+    while line != '' and line.strip() == '':
+        line = F.readline()
+    F.close()
+    return line.lstrip('#').split()
+
+def readAsciiChunks(filename,chunksize=1000000):
+    F = open(filename)
+    for data in parseAsciiChunks(F,chunksize):
+        yield data
+    F.close()
+    return
+
+def parseAsciiChunks(lines,chunksize=1000000):
+
+    names = None
+    chunk = []
+    for line in lines:
+        if line.strip() == '': continue
+        if names is None:
+            names = line.lstrip('#').split()
+            continue
+        if line[0] == '#': continue
+        chunk.append(line)
+        if len(chunk) == chunksize:
+            yield parseAsciiLines(chunk,names)
+            chunk = []
+
+    if len(chunk) > 0:
+        yield parseAsciiLines(chunk,names)
+
+    return
+
+def parseAsciiLines(lines,names):
+    data = numpy.genfromtxt(lines,dtype=None,names=names,deletechars='')
+    return numpy.atleast_1d(data)
+
+# readAsciiChunks is much faster than atpy, but atpy knows many more
+# layouts. Before trusting readAsciiChunks with a catalog, check that the
+# two read its first nlines lines alike: same column names, types and
+# values (NaNs included).
+
+def asciiChunksAgree(filename,nlines=1000):
+
+    F = open(filename)
+    lines = list(itertools.islice(F,nlines))
+    F.close()
 
-    # Observed catalog:
-    try: table.rename_column(config.parameters['ObsMstarName'],'Mstar_obs')
-    except: pass
-    try: table.rename_column(config.parameters['ObsRedshiftName'],'z_obs')
-    except: pass
     try:
-        mag = table[config.parameters['MagName']]
-        table.add_column('mag',mag)
-    except:
-        raise "Error in io.readCatalog: no mag column called "+config.parameters['MagName']
+        chunks = list(parseAsciiChunks(lines,len(lines)))
+        table = atpy.Table(lines, type='ascii')
+    except Exception:
+        return False
+    if len(chunks) != 1: return False
+    data = chunks[0]
+
+    if list(data.dtype.names) != list(table.keys()): return False
+    for name in table.keys():
+        ours,theirs = data[name],numpy.asarray(table[name])
+        if ours.dtype != theirs.dtype: return False
+        same = (ours == theirs)
+        if ours.dtype.kind == 'f':
+            same |= (numpy.isnan(ours) & numpy.isnan(theirs))
+        if not numpy.all(same): return False
+
+    return True
+
+def renameColumns(names,renames):
+    names = list(names)
+    for old,new in renames:
+        if old in names and new not in names:
+            names[names.index(old)] = new
+    return names
 
-    return table
+# ----------------------------------------------------------------------------
+# Make the binary cache without reading the whole catalog into memory:
+# count the rows, then fill one memory-mapped .npy file per column, a chunk
+# at a time. If a chunk needs a wider type than a column has so far (floats
+# after integers, or longer strings), the column is rewritten with the
+# wider type first. Catalogs that only atpy can read are read by it, all
+# at once, so that the cache always holds what atpy would have given.
+# Returns False if the cache could not be written.
+
+def makeCatalogCache(filename,renames,chunksize=1000000):
+
+    if asciiChunksAgree(filename):
+        nrows = -1
+        F = open(filename)
+        for line in F:
+            if line.strip() == '': continue
+            if line[0] == '#' and nrows >= 0: continue
+            nrows += 1
+        F.close()
+        chunks = readAsciiChunks(filename,chunksize)
+    else:
+        whole = atpy.Table(filename, type='ascii')
+        nrows = len(whole)
+        chunks = [whole.data]
+
+    cachedir = getCatalogCacheName(filename)
+    stat = os.stat(filename)
+    manifest = {'size':stat.st_size, 'mtime':stat.st_mtime,
+                'md5':md5sum(filename), 'renames':renames, 'columns':[]}
+    ranges = {}
+
+    scratch = cachedir+'.%i.tmp' % os.getpid()
+    try:
+        rmdir(scratch)
+        os.makedirs(scratch)
+        columns = None
+        first = 0
+        for data in chunks:
+            if columns is None:
+                names = renameColumns(data.dtype.names,renames)
+                columns = []
+                for i,name in enumerate(names):
+                    columnfile = 'column_%03i.npy' % i
+                    dtype = data.dtype[i]
+                    columns.append(numpy.lib.format.open_memmap(scratch+'/'+columnfile,\
+                                       mode='w+',dtype=dtype,shape=(nrows,)))
+                    manifest['columns'].append((name,columnfile))
+            for i,name in enumerate(data.dtype.names):
+                dtype = numpy.promote_types(columns[i].dtype,data.dtype[i])
+                if dtype != columns[i].dtype:
+                    columnfile = scratch+'/'+manifest['columns'][i][1]
+                    columns[i] = widenCacheColumn(columnfile,columns[i],first,dtype)
+                columns[i][first:first+len(data)] = data[name]
+                renamed = manifest['columns'][i][0]
+                if renamed in ['nRA','Dec'] and len(data) > 0:
+                    low,high = data[name].min(),data[name].max()
+                    if renamed in ranges:
+                        low,high = min(low,ranges[renamed][0]),max(high,ranges[renamed][1])
+                    ranges[renamed] = (float(low),float(high))
+            first += len(data)
+        if columns is None: return False
+        if len(ranges) == 2: manifest['ranges'] = ranges
+        for column in columns: column.flush()
+        del columns
+        writePickle(manifest,scratch+'/manifest.pickle')
+        rmdir(cachedir)
+        os.rename(scratch,cachedir)
+    except (IOError,OSError):
+        rmdir(scratch)
+        return False
+
+    return True
+
+# Rewrite a cache column with a wider type, keeping its first nfilled rows:
+
+def widenCacheColumn(columnfile,column,nfilled,dtype):
+
+    widened = numpy.lib.format.open_memmap(columnfile+'.tmp',mode='w+',\
+                                           dtype=dtype,shape=column.shape)
+    widened[:nfilled] = column[:nfilled].astype(dtype)
+    widened.flush()
+    del column
+    os.rename(columnfile+'.tmp',columnfile)
+
+    return widened
+
+# ----------------------------------------------------------------------------
+
+def md5sum(filename,blocksize=2**20):
+    md5 = hashlib.md5()
+    F = open(filename,"rb")
+    block = F.read(blocksize)
+    while len(block) > 0:
+        md5.update(block)
+        block = F.read(blocksize)
+    F.close()
+    return md5.hexdigest()
+
+# ----------------------------------------------------------------------------
+# Cheap fingerprint of a file, to notice when it has been rewritten:
+
+def stamp(filename):
+    try:
+        info = os.stat(filename)
+    except OSError:
+        return None
+    return (info.st_size,info.st_mtime)
 
 # ----------------------------------------------------------------------------
 # Remove file, if it exists, stay quiet otherwise:
@@ -121,4 +640,10 @@ def rm(filename):
         pass
     return
 
+# Same, for directories:
+
+def rmdir(dirname):
+    shutil.rmtree(dirname,ignore_errors=True)
+    return
+
 # ======================================================================
@@ -1,6 +1,6 @@
 
 import numpy, os, string
-import struct, pyfits
+import pyfits
 import cPickle
 
 arcmin2rad = (1.0/60.0)*numpy.pi/180.0
@@ -12,7 +12,7 @@ vb = False
 
 # ============================================================================
 
-class Kappamap:
+class Kappamap(object):
     """
     NAME
         Kappamap
@@ -24,15 +24,21 @@ class Kappamap:
         A "physical" coordinate system is used, where x = -RA (rad) 
         and y = Dec (rad). This is the system favoured by Hilbert et al.
 
+        The pixel values are only read when they are first needed, and
+        then through a memory map, so only the pixels actually looked at
+        are read from disk.
+
     INITIALISATION
         kappafile      Name of file containing a convergence map
         FITS           Data file format (def=True)
             
     METHODS
-        read_in_fits_data(self):
+        read_in_fits_data(self): header now, pixels when needed
 
         read_in_binary_data(self): to cope with hilbert's homegrown format
 
+        load(self): memory-map the pixel values, into self.values
+
         setwcs(self): simulated maps often don't have WCS
 
         get_fits_wcs(self,hdr):
@@ -47,7 +53,8 @@ class Kappamap:
 
         world2image(self,a,d): coord transformation, returns a,d
 
-        at(self,x,y,coordinate_system='physical'): return pixel values
+        at(self,x,y,coordinate_system='physical'): return pixel values,
+            at one position or arrays of them
 
         lookup(self,i,j): return pixel values given image coords
 
@@ -68,6 +75,8 @@ class Kappamap:
 
         self.name = 'Convergence map kappa from Millenium Simulation, zs = 1.6'
         self.input = kappafile
+        self.FITS = FITS
+        self._values = None
 
         # Read in data from file:
 
@@ -83,7 +92,7 @@ class Kappamap:
             self.PIXSCALE = self.field/(1.0*self.NX) # degrees
             self.setwcs()
 
-            # Read in binary data, to self.values:
+            # Binary data are mapped into self.values when needed:
             if vb: print "Reading in map from file "+kappafile
             self.read_in_binary_data()
 
@@ -108,13 +117,10 @@ class Kappamap:
 # ----------------------------------------------------------------------------
 
     def read_in_fits_data(self):
-        hdu = pyfits.open(self.input)[0]
-        hdr = hdu.header
+        hdr = pyfits.getheader(self.input)
         self.get_fits_wcs(hdr)
-        self.values = hdu.data
-        # This transpose is necessary so that ds9 displays the image correctly.
-        self.values = self.values.transpose()
-        self.NX = self.values.shape[0]
+        # The image is transposed on loading, so NAXIS1 is the first axis:
+        self.NX = hdr['NAXIS1']
         self.PIXSCALE = self.wcs['CD1_1']
         self.field = self.NX*self.PIXSCALE
 
@@ -123,15 +129,34 @@ class Kappamap:
 # ----------------------------------------------------------------------------
 
     def read_in_binary_data(self):
-        file = open(self.input,"rb")
-        data = file.read()
-        fmt = str(self.NX*self.NX)+'f'
-        start = 0
-        stop = struct.calcsize(fmt)
-        values = struct.unpack(fmt,data[start:stop])
-        self.values = numpy.array(values,dtype=numpy.float32).reshape(self.NX,self.NX)
+        # The file is just NX*NX native floats - nothing to read until
+        # the values are needed.
+        return None
+
+# ----------------------------------------------------------------------------
+# Pixel values are memory-mapped on first use:
+
+    def load(self):
+        if vb: print "Mapping pixel values from file "+self.input
+        if self.FITS:
+            hdu = pyfits.open(self.input,memmap=True)[0]
+            # This transpose is necessary so that ds9 displays the image
+            # correctly. It is just a view, no copy is made.
+            self._values = hdu.data.transpose()
+        else:
+            self._values = numpy.memmap(self.input,dtype=numpy.float32,mode='r',\
+                                        shape=(self.NX,self.NX))
         return None
 
+    def get_values(self):
+        if self._values is None: self.load()
+        return self._values
+
+    def set_values(self,values):
+        self._values = values
+
+    values = property(get_values,set_values)
+
 # ----------------------------------------------------------------------------
 # WCS parameters: to allow conversions between
 #  image coordinates i,j (pixels)
@@ -179,8 +204,9 @@ class Kappamap:
         for keyword in self.wcs.keys():
           hdu.header.update(keyword,self.wcs[keyword])
         # Make image array. The transpose is necessary so that ds9 displays 
-        # the image correctly.
-        hdu.data = self.values.transpose()
+        # the image correctly. pyfits byteswaps the data in place while
+        # writing, so give it a copy rather than the read-only memory map.
+        hdu.data = numpy.array(self.values.transpose())
         # Verify and write to file:
         hdu.verify()
         hdu.writeto(self.output)
@@ -189,7 +215,8 @@ class Kappamap:
 
 # ----------------------------------------------------------------------------
 # Interpolating the map to return a single value at a specified point - this 
-# is the most important method of this class.
+# is the most important method of this class. x and y can also be arrays,
+# to look up many points in one go.
 
     def at(self,x,y,coordinate_system='physical'):
 
@@ -236,7 +263,7 @@ class Kappamap:
      # Only approximate WCS transformations - assumes dec=0.0 and small field
     def image2world(self,i,j):
         a = self.wcs['CRVAL1'] + self.wcs['CD1_1']*(i - self.wcs['CRPIX1'])
-        if a < 0.0: a += 360.0
+        a = a + 360.0*(a < 0.0)
         d = self.wcs['CRVAL2'] + self.wcs['CD2_2']*(j - self.wcs['CRPIX2'])
         return a,d
 
@@ -248,23 +275,32 @@ class Kappamap:
 # ----------------------------------------------------------------------------
 
     def lookup(self,i,j):
-      
+
         # Weighted mean of 4 neighbouring pixels, as suggested by Stefan.
-        ix = int(i)
-        iy = int(j)
-        px = i - ix
-        py = j - iy
-
-        if ((0 <= ix) and (ix < self.NX-1) and (0 <= iy) and (iy < self.NX-1)):
-            mean =   self.values[ix,iy]    *(1.0-px)*(1.0-py) \
-                  + self.values[ix+1,iy]  * px     *(1.0-py) \
-                  + self.values[ix,iy+1]  *(1.0-px)* py      \
-                  + self.values[ix+1,iy+1]* px     * py
-        else:
-            mean = 0.0        
+        # i and j can be arrays: positions without 4 neighbouring pixels in
+        # the map are masked, and get zero.
+        shape = numpy.broadcast(i,j).shape
+        i = numpy.array(i,dtype=float,ndmin=1).ravel()
+        j = numpy.array(j,dtype=float,ndmin=1).ravel()
+        i,j = numpy.broadcast_arrays(i,j)
+
+        # Truncate towards zero, as int() does:
+        ix = i.astype(int)
+        iy = j.astype(int)
+        inside = (0 <= ix) & (ix < self.NX-1) & (0 <= iy) & (iy < self.NX-1)
+        ix,iy = ix[inside],iy[inside]
+        px = i[inside] - ix
+        py = j[inside] - iy
+
+        mean = numpy.zeros(len(i))
+        mean[inside] =   self.values[ix,iy]    *(1.0-px)*(1.0-py) \
+                      + self.values[ix+1,iy]  * px     *(1.0-py) \
+                      + self.values[ix,iy+1]  *(1.0-px)* py      \
+                      + self.values[ix+1,iy+1]* px     * py
+
+        # Single positions get a single value back:
+        return mean.reshape(shape)[()]
 
-        return mean
-      
 # ============================================================================
 
 if __name__ == '__main__':
@@ -320,12 +356,12 @@ if __name__ == '__main__':
         kappa = numpy.zeros((l/U,l/U,len(kappafiles)))
         print numpy.shape(kappa)
 
+        i,j = numpy.meshgrid(U*numpy.arange(l/U),U*numpy.arange(l/U),indexing='ij')
+
         for k in range(len(kappafiles)):
+           print k
            convergence = Kappamap(kappafiles[k],FITS=False)
-           for i in range(l/U):
-              if i % 500 ==0 : print k,",",i
-              for j in range(l/U):
-                 kappa[i,j,k] = convergence.at(U*i,U*j,coordinate_system='image')
+           kappa[:,:,k] = convergence.at(i,j,coordinate_system='image')
 
         kappa=kappa.ravel()
 
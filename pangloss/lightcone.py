@@ -5,6 +5,9 @@ import pangloss
 import cPickle
 import numpy
 import pylab as plt
+from matplotlib.figure import Figure
+from matplotlib.collections import EllipseCollection
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from math import pi
 
 
@@ -25,6 +28,11 @@ class Lightcone(object):
         Methods are provided to characterise this uncertainty by drawing
         sample masses for each galaxy, from various specified relations.
 
+        The lightcone's own metadata (position, redshifts, totals etc)
+        lives in __slots__, so there is no per-cone __dict__. Lightcones
+        pickled before that are still read: their __dict__ is restored
+        slot by slot, leaving out anything that no longer has one.
+
     INITIALISATION
         catalog       Filename of the parent galaxy catalog
         flavor        Is the catalog 'real' or 'simulated'?
@@ -32,11 +40,26 @@ class Lightcone(object):
         radius        The radius of the lightcone field of view (arcmin)
         maglimit      The depth of the galaxy selection (magnitudes)
         band          The band in which the selection is made
+        index         SkyIndex of the catalog, to avoid searching all of it
+        limits        (xmin,xmax,ymin,ymax) of the parent catalog, when the
+                      catalog given only holds some of its galaxies (eg
+                      those streamed into this cone - which may be none)
+        rows          Catalog row numbers of the galaxies in the cone, if
+                      already known (eg from assignToCones)
+        storage       Keep the galaxies in a GalaxyTable ('arrays', the
+                      default), or in an atpy Table ('atpy')
+        dtype         Floating point type of the galaxy columns, eg
+                      numpy.float32 to halve their size [None: as read]
     
     METHODS
         galaxiesWithin(self,radius,cut=[18.5,24.5],band="F814W",radius_unit="arcsec"):
         
         numberWithin(self,radius,cut=[18.5,24.5],band="F814W",radius_unit="arcsec"):
+            radius can be an array of radii, and cut an array of
+            magnitude windows, to get all their counts at once
+
+        radialIndex(self,band): the galaxies sorted by r, with their
+            magnitudes in band, as a RadialIndex
         
         define_system(self,zl,zs,cosmo=[0.25,0.75,0.73]):
         
@@ -44,6 +67,12 @@ class Lightcone(object):
         
         mimicPhotozError(self,sigma=0.1):
         
+        save(self,filename): write the lightcone to a file that
+            pangloss.readLightcone can memory-map
+
+        setPrecision(self,dtype): cast all the floating point galaxy
+            columns, and any added later, to dtype
+
         writeColumn(self,string,values):
         
         snapToGrid(self, Grid):
@@ -54,10 +83,17 @@ class Lightcone(object):
         
         drawConcentrations(self,errors=False):
         
-        makeKappas(self,errors=False,truncationscale=5,profile="BMO1"):
+        makeKappas(self,errors=False,truncationscale=5,profile="BMO1",lookup=False):
+            lookup=True interpolates the profile in a ProfileTable
         
         combineKappas(self):
 
+        makeRealisations(self,Ns,grid,shmr,sigmaz=0.1,sigmaP=0.45,sigmaS=0.15,
+                         errors=True,truncationscale=10,profile="BMO1",
+                         lookup=False,blocksize=1000000):
+            draw Ns realisations at once, returning their total kappas
+            and gammas
+
     BUGS
 
     AUTHORS
@@ -69,9 +105,18 @@ class Lightcone(object):
       2013-03-23  Collett & Marshall (Cambridge)
     """
 
+    __slots__ = ('name','flavor','catalog','kappa_hilbert','dtype',
+                 'xmax','xmin','ymax','ymin','rmax','xc',
+                 'galaxies','allgalaxies','N_cut','radialindex',
+                 'zl','zs','cosmo','redshifts','dz','Da_l','Da_s','Da_ls',
+                 'kappa_s','kappa_add_total','kappa_keeton_total','kappa_tom_total',
+                 'gamma1_add_total','gamma1_keeton_total','gamma1_tom_total',
+                 'gamma2_add_total','gamma2_keeton_total','gamma2_tom_total',
+                 'G1sum','G2sum','Gsum','mu_add_total')
+
 # ----------------------------------------------------------------------------
 
-    def __init__(self,catalog,flavor,position,radius,maglimit=99,band="r"):
+    def __init__(self,catalog,flavor,position,radius,maglimit=99,band="r",index=None,rows=None,storage='arrays',dtype=None,limits=None):
         
         self.name = 'Lightcone through the Universe'
         self.flavor = flavor   # 'real' or 'simulated'
@@ -79,12 +124,21 @@ class Lightcone(object):
         
         # Simulated lightcones have "true" (ray-traced) convergence:
         self.kappa_hilbert = None # until set!
+
+        # Floating point type of the galaxy columns (None: as read in):
+        self.dtype = None
         
-        # Catalog limits:
-        self.xmax = self.catalog['nRA'].max()
-        self.xmin = self.catalog['nRA'].min()
-        self.ymax = self.catalog['Dec'].max()
-        self.ymin = self.catalog['Dec'].min() 
+        # Catalog limits (already known, if the catalog has been indexed):
+        if limits is not None:
+            self.xmin,self.xmax,self.ymin,self.ymax = limits
+        elif index is None:
+            self.xmax = self.catalog['nRA'].max()
+            self.xmin = self.catalog['nRA'].min()
+            self.ymax = self.catalog['Dec'].max()
+            self.ymin = self.catalog['Dec'].min() 
+        else:
+            self.xmax,self.xmin = index.xmax,index.xmin
+            self.ymax,self.ymin = index.ymax,index.ymin
         
         # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
 
@@ -93,10 +147,20 @@ class Lightcone(object):
         self.xc = [position[0],position[1]]
 
         dx = self.rmax*pangloss.arcmin2rad
-        self.galaxies = self.catalog.where((self.catalog.nRA > (self.xc[0]-dx)) & \
-                                           (self.catalog.nRA < (self.xc[0]+dx)) & \
-                                           (self.catalog.Dec > (self.xc[1]-dx)) & \
-                                           (self.catalog.Dec < (self.xc[1]+dx))   )
+        if rows is not None:
+            self.galaxies = self.catalog.rows(rows)
+        elif index is None:
+            self.galaxies = self.catalog.where((self.catalog.nRA > (self.xc[0]-dx)) & \
+                                               (self.catalog.nRA < (self.xc[0]+dx)) & \
+                                               (self.catalog.Dec > (self.xc[1]-dx)) & \
+                                               (self.catalog.Dec < (self.xc[1]+dx))   )
+        else:
+            self.galaxies = self.catalog.rows(index.box(self.xc[0],self.xc[1],dx))
+
+        # Columns added from now on will be overwritten in place by each
+        # realisation, rather than copying the whole table every time:
+        if storage == 'arrays':
+            self.galaxies = pangloss.GalaxyTable(self.galaxies)
 
         # Trim it to a circle:
         x = (self.galaxies.nRA - self.xc[0])*pangloss.rad2arcmin
@@ -136,6 +200,8 @@ class Lightcone(object):
         if len(self.galaxies) == 0: 
             print "Lightcone: WARNING: no galaxies here!"
 
+        if dtype is not None: self.setPrecision(dtype)
+
         # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
 
         # Save memory! 
@@ -149,39 +215,59 @@ class Lightcone(object):
     def __str__(self):
         return 'Lightcone of radius %.2f arcmin, centred on (%.3f,%.3f) rad' % (self.rmax,self.xc[0],self.xc[1])
 
+# ----------------------------------------------------------------------------
+# Pickle the slots that have been set, as a dictionary - which is also what
+# lightcones pickled before there were slots hold. The radial index is
+# left out: it is a sorted copy of columns that are pickled anyway, and
+# radialIndex makes it again when it is next needed.
+
+    def __getstate__(self):
+        state = {}
+        for name in self.__slots__:
+            if name == 'radialindex': continue
+            try:
+                state[name] = getattr(self,name)
+            except AttributeError:
+                pass
+        return state
+
+    def __setstate__(self,state):
+        for name,value in state.items():
+            if name in self.__slots__: setattr(self,name,value)
+        return
+
 # ----------------------------------------------------------------------------
 # Tell me the number of galaxies within a certain radius, that pass a 
 # certain magnitude cut.
 
     def galaxiesWithin(self,radius,cut=[18.5,24.5], band="F814W", radius_unit="arcmin"):
 
-        if band == "u" or band ==  "g" or band == "r" or band ==  "i" or band == "z":
-            col = "mag_SDSS_%s" % band
-        elif band == "F814" or band == "F814W" or band == "814" or band == 814:
-            col = "mag_F814W"
-        elif band == "WFC125" or band == "F125W" or band == "F125" or band == "125" or band == 125:
-            col = "WFC125"
-        else:
-            col = "mag_%s" % band
-        if radius < 0.1: 
-            print "Warning: Default units for radius are arcmin!"
-        if radius_unit == "arcmin":
-            radius = radius
-        if radius_unit == "arcsec":
-            radius = radius/60.            
-        if col != "warning":
-          #  self.N_cut=self.galaxies.where((self.galaxies.r < radius)  & \
-          #                                    (self.galaxies["%s"%col] < cut[1])& \
-          #                                (self.galaxies["%s"%col] > cut[0]))
-            self.N_cut=self.galaxies.where((self.galaxies.r < radius)  & \
-                                           (self.galaxies["%s"%col] < cut[1])& \
-                                           (self.galaxies["%s"%col] > cut[0]))
-                                          
-            return self.N_cut
+        radius = radiusInArcmin(radius,radius_unit)
+        rows = self.radialIndex(band).rows(radius,cut)
+        self.N_cut = self.galaxies.rows(rows)
+
+        return self.N_cut
+
+# Counting needs no new table: radius can be an array (eg to get the number
+# count vs radius curve), and cut an array of magnitude windows, one per row.
 
     def numberWithin(self,radius,cut=[18.5,24.5],band="F125W",units="arcmin"):
-        Ntable = self.galaxiesWithin(radius,cut,band,units)
-        return len(Ntable.r)
+        radius = radiusInArcmin(radius,units)
+        return self.radialIndex(band).count(radius,cut)
+
+# The index is kept until the galaxies are next reselected:
+
+    def radialIndex(self,band):
+
+        col = magnitudeColumn(band)
+        cache = getattr(self,'radialindex',None)
+        if cache is None or cache[0] is not self.galaxies:
+            cache = (self.galaxies,{})
+            self.radialindex = cache
+        if col not in cache[1]:
+            cache[1][col] = pangloss.RadialIndex(self.galaxies.r,self.galaxies[col])
+
+        return cache[1][col]
 
 # ----------------------------------------------------------------------------
 
@@ -216,15 +302,7 @@ class Lightcone(object):
         assert len(SR)==len(SD)
 
         band = experiment.parameters['LightconeDepthBand']
-
-        if band == "u" or band ==  "g" or band == "r" or band ==  "i" or band == "z":
-            col = "mag_SDSS_%s" % band
-        elif band == "F814" or band == "F814W" or band == "814" or band == 814:
-            col = "mag_F814W" #note that this isn't included atm
-        elif band == "WFC125" or band == "F125" or band == "F125W" or band == "125" or band == 125:
-            col = "WFC125" #this was the matching band for BoRG
-        else:
-            col = "mag_%s" % band
+        col = magnitudeColumn(band)
             
         # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - - 
         # Only include galaxies observed by photometry:
@@ -232,15 +310,9 @@ class Lightcone(object):
         self.writeColumn('photo_flag',False)
         self.writeColumn('identifier',range(len(self.galaxies.x)))
         if PR != ['']:
-            for i in range(len(PR)):
-                R=PR[i]*60 # positions are stored in arcseconds
-                D=PD[i]
-
-                goodset = set(self.galaxies.where((self.galaxies.r < R) & \
-                   (self.galaxies["%s"%col] < D)).identifier)
-
-                self.galaxies.photo_flag[numpy.array(\
-                   [_ in goodset for _ in self.galaxies.identifier])]=True
+            # positions are stored in arcseconds
+            self.galaxies.photo_flag[...] = inFootprint(self.galaxies.r,self.galaxies["%s"%col],\
+                                                  numpy.array(PR)*60,numpy.array(PD))
         
         self.galaxies = self.galaxies.where(self.galaxies.photo_flag==True)
 
@@ -251,15 +323,21 @@ class Lightcone(object):
         self.writeColumn('spec_flag',False)
 
         if SR!=['']:
-            for i in range(len(SR)):
-                R=SR[i]*60 # positions are stored in arcseconds
-                D=SD[i]
-                goodset=set(self.galaxies.where((self.galaxies.r < R) & \
-                   (self.galaxies["%s"%col] < D)).identifier)
+            # positions are stored in arcseconds
+            self.galaxies.spec_flag[...] = inFootprint(self.galaxies.r,self.galaxies["%s"%col],\
+                                                 numpy.array(SR)*60,numpy.array(SD))
 
-                self.galaxies.spec_flag[numpy.array(\
-                   [_ in goodset for _ in self.galaxies.identifier])]=True
+        return
 
+# ----------------------------------------------------------------------------
+# Save the lightcone as a LightconeArchive holding just this one cone: a
+# small versioned header, and then the raw galaxy columns, which
+# pangloss.readLightcone maps into memory instead of copying them.
+
+    def save(self,filename):
+        archive = pangloss.LightconeArchive(filename,mode='w',spool=False)
+        archive.append(self)
+        archive.close()
         return
 
 # ----------------------------------------------------------------------------
@@ -267,9 +345,38 @@ class Lightcone(object):
 # (previous ones are single use per lightcone)
 # ----------------------------------------------------------------------------
 
+# Cast the floating point galaxy columns to single (numpy.float32) or
+# double (numpy.float64) precision. Columns written later are cast too, by
+# writeColumn, and makeRealisations computes in the same precision.
+
+    def setPrecision(self,dtype):
+
+        self.dtype = numpy.dtype(dtype)
+
+        names = self.galaxies.keys()
+        recast = [name for name in names if self.galaxies[name].dtype.kind == 'f' \
+                                        and self.galaxies[name].dtype != self.dtype]
+        if len(recast) == 0: return
+
+        # Make a new table of the same kind, keeping the column order:
+        table = self.galaxies.__class__()
+        for name in names:
+            values = self.galaxies[name]
+            if name in recast: values = values.astype(self.dtype)
+            table.add_column(name,values)
+        if self.allgalaxies is self.galaxies: self.allgalaxies = table
+        self.galaxies = table
+
+        return
+
+# ----------------------------------------------------------------------------
 # Add galaxy property column, overwriting any values that already exist:
 
     def writeColumn(self,string,values):
+        dtype = getattr(self,'dtype',None)
+        if dtype is not None:
+            values = numpy.asarray(values)
+            if values.dtype.kind == 'f': values = values.astype(dtype)
         try:
             self.galaxies.add_column('%s'%string,values)
         except ValueError:
@@ -357,7 +464,7 @@ class Lightcone(object):
 # ----------------------------------------------------------------------------
 # Compute halos' contributions to the convergence:
 
-    def makeKappas(self,errors=False,truncationscale=5,profile="BMO1"):
+    def makeKappas(self,errors=False,truncationscale=5,profile="BMO1",lookup=False):
             
         c200 = self.galaxies.c200
         r200 = self.galaxies.r200
@@ -366,23 +473,29 @@ class Lightcone(object):
         rho_s = pangloss.delta_c(c200)*self.galaxies.rho_crit
         self.kappa_s = rho_s * r_s /self.galaxies.sigma_crit  #kappa slice for each lightcone
         
+        phi = self.galaxies.phi        
+        kappa_s = self.kappa_s
+        
         r_trunc = truncationscale*r200
         xtrunc = r_trunc/r_s
-        kappaHalo = self.kappa_s*1.0
-        gammaHalo = self.kappa_s*1.0
+        kappaHalo = kappa_s*1.0
+        gammaHalo = kappa_s*1.0
         
-        if profile=="BMO1":
+        if lookup:
+            # Interpolate in a table of the profile, made once per process:
+            F,G=pangloss.getProfileTable(profile).evaluate(x,xtrunc)
+
+        elif profile=="BMO1":
             F=pangloss.BMO1Ffunc(x,xtrunc)
             G=pangloss.BMO1Gfunc(x,xtrunc)
         
-        if profile=="BMO2":
+        elif profile=="BMO2":
             F=pangloss.BMO2Ffunc(x,xtrunc)
             G=pangloss.BMO2Gfunc(x,xtrunc)
         
         kappaHalo *= F
         gammaHalo *= (G-F)
 
-        phi = self.galaxies.phi        
         kappa = kappaHalo 
         gamma = gammaHalo
         gamma1 = gamma*numpy.cos(2*phi)
@@ -470,47 +583,169 @@ class Lightcone(object):
 
         return self.mu_add_total       
 
+# ----------------------------------------------------------------------------
+# Draw Ns realisations of the lightcone in one go: the same chain as
+# mimicPhotozError, snapToGrid, drawMstars, mimicMstarError, drawMhalos,
+# drawConcentrations, makeKappas and combineKappas, but on (realisation x
+# galaxy) arrays, a block of realisations at a time so that no block has
+# more than blocksize elements. The galaxy table is not written to.
+#
+# The realisations are drawn just as the step by step chain draws them. In
+# particular, a simulated lightcone's mock Mstar_obs values are drawn from
+# the halo masses of the realisation before (the first from the Mh column),
+# as drawMstars does when it follows the last realisation's drawMhalos -
+# so for simulated lightcones, the stellar and halo masses are drawn one
+# realisation at a time (each over all the galaxies at once), and only the
+# rest of the chain is done a block of realisations at a time.
+#
+# Returns a dictionary of arrays of Ns totals, with the same names as the
+# totals combineKappas sets: kappa_add, kappa_keeton, kappa_tom, and the
+# same for gamma1 and gamma2.
+
+    def makeRealisations(self,Ns,grid,shmr,sigmaz=0.1,sigmaP=0.45,sigmaS=0.15,\
+                         errors=True,truncationscale=10,profile="BMO1",lookup=False,\
+                         blocksize=1000000):
+
+        N = len(self.galaxies)
+        names = ['kappa_add','kappa_keeton','kappa_tom',\
+                 'gamma1_add','gamma1_keeton','gamma1_tom',\
+                 'gamma2_add','gamma2_keeton','gamma2_tom']
+        # Everything is computed in the precision of the galaxy columns:
+        dtype = getattr(self,'dtype',None)
+        if dtype is None: dtype = numpy.dtype(numpy.float64)
+        totals = dict([(name,numpy.zeros(Ns,dtype=dtype)) for name in names])
+        if N == 0: return totals
+
+        z_obs = self.galaxies.z_obs
+        spec = (self.galaxies.spec_flag == True)
+        r = self.galaxies.r*pangloss.arcmin2rad
+        phi = self.galaxies.phi
+        if self.flavor == 'simulated':
+            lastMh = self.galaxies.Mh
+        else:
+            Mstar_obs = self.galaxies.Mstar_obs
+
+        # Errors on z and Mstar are set by the spectroscopic flag:
+        zerr = ((spec == False)*sigmaz*(1+z_obs)).astype(dtype)
+        Mstarerr = numpy.where(spec,sigmaS,sigmaP).astype(dtype)
+
+        # Lens plane quantities. Spectroscopic redshifts never change, so
+        # the spectroscopic galaxies' planes (and physical radii) are
+        # looked up once, here, and used for every block; only the
+        # photometric galaxies are snapped afresh:
+        planes = dict([(name,getattr(grid,name).astype(dtype)) \
+                       for name in ('Da_p','rho_crit','sigma_crit','beta')])
+        static,moving = numpy.flatnonzero(spec),numpy.flatnonzero(spec == False)
+        sz,p = grid.snap(z_obs[static])
+        staticplanes = dict([(name,planes[name][p]) for name in planes])
+        staticrphys = r[static]*staticplanes['Da_p']
+
+        B = max(1,blocksize/N)
+        for first in range(0,Ns,B):
+            n = min(B,Ns-first)
+            shape = (n,N)
+
+            # Photometric redshifts, snapped onto the grid:
+            z = z_obs + zerr*numpy.random.randn(n,N).astype(dtype)
+            sz,p = grid.snap(z[:,moving].ravel())
+            p = p.reshape(n,len(moving))
+            snapped = {}
+            for name in planes:
+                snapped[name] = numpy.empty(shape,dtype=planes[name].dtype)
+                snapped[name][:,static] = staticplanes[name]
+                snapped[name][:,moving] = planes[name][p]
+            Da_p,rho_crit = snapped['Da_p'],snapped['rho_crit']
+            sigma_crit,beta = snapped['sigma_crit'],snapped['beta']
+            rphys = numpy.empty(shape,dtype=staticrphys.dtype)
+            rphys[:,static] = staticrphys
+            rphys[:,moving] = r[moving]*Da_p[:,moving]
+
+            # Stellar masses, then halo masses:
+            if self.flavor == 'simulated':
+                Mh = numpy.empty(shape,dtype=dtype)
+                for j in range(n):
+                    Mstar_obs = shmr.drawMstars(lastMh,z[j]).astype(dtype)
+                    Mstar = Mstar_obs + Mstarerr*numpy.random.randn(N).astype(dtype)
+                    Mh[j] = shmr.drawMhalos(Mstar,z[j])
+                    lastMh = Mh[j]
+            else:
+                Mstar = Mstar_obs + Mstarerr*numpy.random.randn(n,N).astype(dtype)
+                Mh = shmr.drawMhalos(Mstar.ravel(),z.ravel()).reshape(shape).astype(dtype)
+
+            # Concentrations:
+            M200 = 10**Mh
+            r200 = (3*M200/(800*3.14159*rho_crit))**(1./3)
+            c200 = pangloss.MCrelation(M200.ravel(),scatter=errors).reshape(shape).astype(dtype)
+            r_s = r200/c200
+            x = rphys/r_s
+
+            # Each halo's convergence and shear:
+            rho_s = pangloss.delta_c(c200)*rho_crit
+            kappa_s = rho_s * r_s /sigma_crit
+            xtrunc = (truncationscale*r200/r_s).ravel()
+            x = x.ravel()
+            if lookup:
+                F,G=pangloss.getProfileTable(profile).evaluate(x,xtrunc)
+                F,G=F.reshape(shape),G.reshape(shape)
+            elif profile=="BMO1":
+                F=pangloss.BMO1Ffunc(x,xtrunc).reshape(shape)
+                G=pangloss.BMO1Gfunc(x,xtrunc).reshape(shape)
+            elif profile=="BMO2":
+                F=pangloss.BMO2Ffunc(x,xtrunc).reshape(shape)
+                G=pangloss.BMO2Gfunc(x,xtrunc).reshape(shape)
+            K = kappa_s*F
+            G = kappa_s*(G-F)
+            G1 = -G*numpy.cos(2*phi)
+            G2 = -G*numpy.sin(2*phi)
+
+            # Combine them along the line of sight, as in combineKappas:
+            D = K**2-G**2
+            denominator = (1-beta*K)**2 - (beta*G)**2
+            block = slice(first,first+n)
+            totals['kappa_add'][block] = K.sum(axis=1)
+            totals['kappa_keeton'][block] = ((1.-beta)*(K-beta*D)/denominator).sum(axis=1)
+            totals['kappa_tom'][block] = ((1.-beta)*K).sum(axis=1)
+            totals['gamma1_add'][block] = G1.sum(axis=1)
+            totals['gamma1_keeton'][block] = ((1.-beta)*G1/denominator).sum(axis=1)
+            totals['gamma1_tom'][block] = ((1.-beta)*G1).sum(axis=1)
+            totals['gamma2_add'][block] = G2.sum(axis=1)
+            totals['gamma2_keeton'][block] = ((1.-beta)*G2/denominator).sum(axis=1)
+            totals['gamma2_tom'][block] = ((1.-beta)*G2).sum(axis=1)
+
+        return totals
+
 # ----------------------------------------------------------------------------
 # Find contribution of various quantities along LoS at given z
-# for plotting cumulative sums of parameters with z
+# for plotting cumulative sums of parameters with z. quantity can be one
+# name, or a list of them (giving one row of contributions per name); z is
+# the array of redshifts to find the cumulative sums at. The galaxies are
+# sorted by redshift once, and each sum is then read off a cumulative sum.
 
-    def findContributions(self,quantity):
+    def findContributions(self,quantity,z=None):
        
        # Point positions:
-       zmax = self.zs+0.1
-       zbins = 15
-       z = numpy.linspace(0.0,zmax,zbins)
-       # Plot the points:
-       if quantity == 'mass':
-           contr = numpy.zeros(zbins)
-           for i in range(zbins):
-               galaxies = self.galaxies.where(self.galaxies.z <= z[i])
-               size = galaxies.Mhalo_obs
-               contr[i] = numpy.sum(size)
-      
-       elif quantity == 'kappa':
-           contr = numpy.zeros(zbins)
-           for i in range(zbins):
-               galaxies = self.galaxies.where(self.galaxies.z <= z[i])
-               size = galaxies.kappa
-               contr[i] = numpy.sum(size)           
-       
-       elif quantity == 'mu':
-           contr = numpy.zeros(zbins)
-           for i in range(zbins):
-               galaxies = self.galaxies.where(self.galaxies.z <= z[i])
-               size = galaxies.mu
-               contr[i] = numpy.sum(size)           
-
-       elif quantity == 'stellarmass':
-           contr = numpy.zeros(zbins)
-           for i in range(zbins):
-               galaxies = self.galaxies.where(self.galaxies.z <= z[i])
-               size = galaxies.Mstar_obs
-               contr[i] = numpy.sum(size)           
-       else:
-           raise "Lightcone plotting error: unknown quantity "+quantity
-
+       if z is None:
+           zmax = self.zs+0.1
+           zbins = 15
+           z = numpy.linspace(0.0,zmax,zbins)
+
+       columns = {'mass':'Mhalo_obs','kappa':'kappa','mu':'mu','stellarmass':'Mstar_obs'}
+       single = isinstance(quantity,basestring)
+       if single: quantity = [quantity]
+
+       order = numpy.argsort(self.galaxies.z,kind='mergesort')
+       # Number of galaxies with redshift <= each z:
+       n = numpy.searchsorted(self.galaxies.z[order],z,side='right')
+
+       contr = numpy.zeros((len(quantity),len(z)))
+       for i in range(len(quantity)):
+           if quantity[i] not in columns:
+               raise "Lightcone plotting error: unknown quantity "+quantity[i]
+           size = self.galaxies[columns[quantity[i]]][order]
+           cumulative = numpy.concatenate(([0.0],numpy.cumsum(size)))
+           contr[i] = cumulative[n]
+
+       if single: contr = contr[0]
        return contr
 
 # ----------------------------------------------------------------------------
@@ -524,29 +759,32 @@ class Lightcone(object):
        if quantity == 'mass':
            self.writeColumn('rtrunc_arcmin',(self.galaxies.r200/ self.galaxies.Da_p) * pangloss.rad2arcmin)
            self.writeColumn('rscale_arcmin',(self.galaxies.rs/ self.galaxies.Da_p) * pangloss.rad2arcmin)
-           for i in range(len(self.galaxies.x)):
-               trunc = plt.Circle([self.galaxies.x[i], self.galaxies.y[i]],radius=self.galaxies.rtrunc_arcmin[i],fill=True,fc="b",alpha=0.05)
-               AX.add_patch(trunc)
-           for i in range(len(self.galaxies.x)):
-               core = plt.Circle([self.galaxies.x[i], self.galaxies.y[i]],radius=self.galaxies.rscale_arcmin[i],fill=True,fc="r",alpha=0.5)
-               AX.add_patch(core)
-           plt.title('Halo Mass')
+           # One collection of circles each for the truncation and scale
+           # radii, sized in data units, rather than a patch per galaxy:
+           xy = numpy.column_stack((self.galaxies.x,self.galaxies.y))
+           for radius,colour,alpha in ((self.galaxies.rtrunc_arcmin,"b",0.05),\
+                                       (self.galaxies.rscale_arcmin,"r",0.5)):
+               circles = EllipseCollection(2*radius,2*radius,numpy.zeros(len(radius)),units='xy',\
+                                           offsets=xy,transOffset=AX.transData,\
+                                           facecolors=colour,edgecolors=colour,linewidths=0,alpha=alpha)
+               AX.add_collection(circles)
+           AX.set_title('Halo Mass')
 
        elif quantity == 'kappa':
-           plt.scatter(self.galaxies.x, self.galaxies.y, c='r', marker='o', s=(self.galaxies.kappa)*30000)    
-           plt.title('Convergence')
+           AX.scatter(self.galaxies.x, self.galaxies.y, c='r', marker='o', s=(self.galaxies.kappa)*30000)    
+           AX.set_title('Convergence')
        
        elif quantity == 'mu':
-           plt.scatter(self.galaxies.x, self.galaxies.y, c='g', marker='o', s=((self.galaxies.mu-1.0)*3E4))    
-           plt.title('Magnification')
+           AX.scatter(self.galaxies.x, self.galaxies.y, c='g', marker='o', s=((self.galaxies.mu-1.0)*3E4))    
+           AX.set_title('Magnification')
        
        elif quantity == 'stellarmass':
-           plt.scatter(self.galaxies.x, self.galaxies.y, c='y', marker='o', s=(numpy.log(self.galaxies.Mstar)/2),edgecolor = 'none' )     
-           plt.title('Stellar Mass')
+           AX.scatter(self.galaxies.x, self.galaxies.y, c='y', marker='o', s=(numpy.log(self.galaxies.Mstar)/2),edgecolor = 'none' )     
+           AX.set_title('Stellar Mass')
        
        elif quantity == 'light':
-           plt.scatter(self.galaxies.x, self.galaxies.y, c='y', marker='o', s=(2**(25-self.galaxies.mag)),edgecolor = 'none' )     
-           plt.title('Galaxy Light')
+           AX.scatter(self.galaxies.x, self.galaxies.y, c='y', marker='o', s=(2**(25-self.galaxies.mag)),edgecolor = 'none' )     
+           AX.set_title('Galaxy Light')
 
        else:
            raise "Lightcone plotting error: unknown quantity "+quantity
@@ -559,12 +797,12 @@ class Lightcone(object):
        AX.axis(axlimits)
 
        # Show slice:
-       plt.axvline(x=slicehalfwidth, ymin=axlimits[2], ymax=axlimits[3],color='black', ls='dotted')
-       plt.axvline(x=-slicehalfwidth, ymin=axlimits[2], ymax=axlimits[3],color='black', ls='dotted')
+       AX.axvline(x=slicehalfwidth, ymin=axlimits[2], ymax=axlimits[3],color='black', ls='dotted')
+       AX.axvline(x=-slicehalfwidth, ymin=axlimits[2], ymax=axlimits[3],color='black', ls='dotted')
        
        # Labels:
-       plt.xlabel('x / arcmin')
-       # plt.ylabel('y / arcmin')
+       AX.set_xlabel('x / arcmin')
+       # AX.set_ylabel('y / arcmin')
        
        return
 
@@ -583,28 +821,28 @@ class Lightcone(object):
        # Plot the points:
        if quantity == 'mass':
            size = (10.0**(self.galaxies.Mh[subset]-11.0))
-           plt.scatter(z, y, c='k', marker='o', s=size, edgecolor='none' )
-           plt.title('Line-of-sight Halo Mass')
+           AX.scatter(z, y, c='k', marker='o', s=size, edgecolor='none' )
+           AX.set_title('Line-of-sight Halo Mass')
       
        elif quantity == 'kappa':
            size = ((self.galaxies.kappa[subset])*30000.0)
-           plt.scatter(z, y, c='r', marker='o', s=size, edgecolor='k' )
-           plt.title('Line-of-sight Convergence')
+           AX.scatter(z, y, c='r', marker='o', s=size, edgecolor='k' )
+           AX.set_title('Line-of-sight Convergence')
        
        elif quantity == 'mu':
            size = ((self.galaxies.mu[subset]-1.0)*3E4)
-           plt.scatter(z, y, c='g', marker='o', s=size, edgecolor='k' )
-           plt.title(r'Line-of-sight Magnification $(\mu - 1)$')  
+           AX.scatter(z, y, c='g', marker='o', s=size, edgecolor='k' )
+           AX.set_title(r'Line-of-sight Magnification $(\mu - 1)$')  
 
        elif quantity == 'stellarmass':
            size = ((numpy.log(self.galaxies.Mstar[subset]))/2.0)
-           plt.scatter(z, y, c='y', marker='o', s=size, edgecolor='none' )
-           plt.title('Line-of-sight Stellar Mass')
+           AX.scatter(z, y, c='y', marker='o', s=size, edgecolor='none' )
+           AX.set_title('Line-of-sight Stellar Mass')
 
        elif quantity == 'light':
            size = (2**(25-(self.galaxies.mag[subset])))     
-           plt.scatter(z, y, c='y', marker='o', s=size, edgecolor='none' )
-           plt.title('Line-of-sight Galaxy Light')
+           AX.scatter(z, y, c='y', marker='o', s=size, edgecolor='none' )
+           AX.set_title('Line-of-sight Galaxy Light')
 
        else:
            raise "Lightcone plotting error: unknown quantity "+quantity
@@ -614,13 +852,13 @@ class Lightcone(object):
        AX.axis([0,zmax+0.1,-self.rmax-0.1,self.rmax+0.1])
 
        # Labels:
-       plt.xlabel('redshift z')
-       plt.ylabel('y / arcmin')
+       AX.set_xlabel('redshift z')
+       AX.set_ylabel('y / arcmin')
       
        # Add lines marking source and lens plane, and optical axis:
-       plt.axvline(x=self.zl, ymin=0, ymax=1,color='black', ls='dotted',label='bla')
-       plt.axvline(x=self.zs, ymin=0, ymax=1,color='black', ls='dotted')
-       plt.axhline(y=0.0, xmin=0.0, xmax=zmax, color='black', ls='dashed')
+       AX.axvline(x=self.zl, ymin=0, ymax=1,color='black', ls='dotted',label='bla')
+       AX.axvline(x=self.zs, ymin=0, ymax=1,color='black', ls='dotted')
+       AX.axhline(y=0.0, xmin=0.0, xmax=zmax, color='black', ls='dashed')
 
        return
 
@@ -629,91 +867,130 @@ class Lightcone(object):
 
     def plotContributions(self,quantity,output):
        
-       plt.clf()
+       figure = newFigure(output)
+       AX = figure.add_subplot(1,1,1)
  
        # Point positions:
        zmax = self.zs+0.1
        z = numpy.linspace(0.0,zmax,100)
        # Plot the points:
-       if quantity == 'mass':
-           contr = numpy.zeros(len(z))
-           for i in range(len(z)):
-               galaxies = self.galaxies.where(self.galaxies.z <= z[i])
-               size = galaxies.Mhalo_obs
-               contr[i] = numpy.sum(size)
-           plt.plot(z, contr)
-           plt.title('Cumulative Sum of Halo Mass')
-      
-       elif quantity == 'kappa':
-           contr = numpy.zeros(len(z))
-           for i in range(len(z)):
-               galaxies = self.galaxies.where(self.galaxies.z <= z[i])
-               size = galaxies.kappa
-               contr[i] = numpy.sum(size)           
-           plt.plot(z, contr)
-           plt.title(r'Cumulative Sum of $\kappa_h$')
-       
-       elif quantity == 'mu':
-           contr = numpy.zeros(len(z))
-           for i in range(len(z)):
-               galaxies = self.galaxies.where(self.galaxies.z <= z[i])
-               size = galaxies.mu
-               contr[i] = numpy.sum(size)           
-           plt.plot(z, contr)
-           plt.title(r'Cumulative Sum of $\mu_h$')  
-
-       elif quantity == 'stellarmass':
-           contr = numpy.zeros(len(z))
-           for i in range(len(z)):
-               galaxies = self.galaxies.where(self.galaxies.z <= z[i])
-               size = galaxies.Mstar_obs
-               contr[i] = numpy.sum(size)           
-           plt.plot(z, contr)
-           plt.title('Cumulative Sum of Stellar Mass')
-
-       else:
+       titles = {'mass':'Cumulative Sum of Halo Mass',
+                 'kappa':r'Cumulative Sum of $\kappa_h$',
+                 'mu':r'Cumulative Sum of $\mu_h$',
+                 'stellarmass':'Cumulative Sum of Stellar Mass'}
+       if quantity not in titles:
            raise "Lightcone plotting error: unknown quantity "+quantity
+       contr = self.findContributions(quantity,z)
+       AX.plot(z, contr)
+       AX.set_title(titles[quantity])
 
        # Axis limits:
        zmax = max(self.galaxies.z.max(),self.zs+0.1)
        
        # Labels:
-       plt.xlabel('redshift z')
+       AX.set_xlabel('redshift z')
 
-       if output != None:
-           pangloss.rm(output)
-           plt.savefig(output,dpi=300)
+       saveFigure(figure,output)
 
        return
 # ----------------------------------------------------------------------------
 
     def plot(self,var='kappa',output=None):
 
-       plt.clf()
+       figure = newFigure(output)
 
        # Panel 1: Galaxy positions:
-       ax1 = plt.subplot(3,3,(1,4), aspect ='equal')
+       ax1 = figure.add_subplot(3,3,(1,4), aspect ='equal')
        self.plotFieldOfView('light',ax1)
        
        # Panel 2: Halo mass distributions:
-       ax2 = plt.subplot(3,3,(2,5), aspect ='equal')
+       ax2 = figure.add_subplot(3,3,(2,5), aspect ='equal')
        self.plotFieldOfView('mass',ax2)
 
        # Panel 3: Kappa contributions:
-       ax3 = plt.subplot(3,3,(3,6), aspect ='equal')
+       ax3 = figure.add_subplot(3,3,(3,6), aspect ='equal')
        self.plotFieldOfView(var,ax3)
        
        # Lower panel: View along redshift axis
-       ax4 = plt.subplot(3,3,(7,9))
+       ax4 = figure.add_subplot(3,3,(7,9))
        self.plotLineOfSight(var,ax4)
        
-       if output != None:
-           pangloss.rm(output)
-           plt.savefig(output,dpi=300)
+       saveFigure(figure,output)
        
        return None
        
 # ----------------------------------------------------------------------------
     
 
+# ============================================================================
+# Figures that are going straight to a file are drawn by the Agg backend,
+# without going through pyplot: that needs no display, leaves the current
+# pyplot figure alone, and is safe in a background process. Otherwise, the
+# current pyplot figure is cleared and drawn on, as before.
+
+def newFigure(output=None):
+    if output is None:
+        plt.clf()
+        return plt.gcf()
+    figure = Figure(figsize=plt.rcParams['figure.figsize'])
+    FigureCanvasAgg(figure)
+    return figure
+
+def saveFigure(figure,output=None):
+    if output is None: return
+    pangloss.rm(output)
+    figure.savefig(output,dpi=300)
+    return
+
+# Lightcone.plot, as a function that a worker process can be handed (eg by
+# multiprocessing.Pool.apply_async) along with the lightcone to plot:
+
+def plotLightcone(lc,output,var='kappa'):
+    lc.plot(var=var,output=output)
+    return output
+
+# ============================================================================
+# Which galaxies are inside any of a set of rings, each with its own depth?
+# A galaxy at radius r is seen by every ring with R > r, so it is in the
+# footprint if it is brighter than the deepest of those. Sorting the rings
+# by radius, the deepest ring outside each radius is a reverse cumulative
+# maximum, and one searchsorted finds it for every galaxy at once.
+
+def inFootprint(r,mag,radii,depths):
+
+    order = numpy.argsort(radii)
+    radii = radii[order]
+    deepest = numpy.maximum.accumulate(depths[order][::-1])[::-1]
+
+    k = numpy.searchsorted(radii,r,side='right')
+    inside = (k < len(radii))
+    seen = numpy.zeros(len(r),dtype=bool)
+    seen[inside] = (mag[inside] < deepest[k[inside]])
+
+    return seen
+
+# ============================================================================
+# Radii are in arcmin by default; the warning is for anyone who forgot:
+
+def radiusInArcmin(radius,unit="arcmin"):
+    if numpy.min(radius) < 0.1:
+        print "Warning: Default units for radius are arcmin!"
+    if unit == "arcsec":
+        radius = numpy.asarray(radius)/60.
+    return radius
+
+# ============================================================================
+# Name of the catalog column holding magnitudes in a given band:
+
+def magnitudeColumn(band):
+    if band == "u" or band ==  "g" or band == "r" or band ==  "i" or band == "z":
+        col = "mag_SDSS_%s" % band
+    elif band == "F814" or band == "F814W" or band == "814" or band == 814:
+        col = "mag_F814W" #note that this isn't included atm
+    elif band == "WFC125" or band == "F125" or band == "F125W" or band == "125" or band == 125:
+        col = "WFC125" #this was the matching band for BoRG
+    else:
+        col = "mag_%s" % band
+    return col
+
 #=============================================================================
@@ -0,0 +1,202 @@
+# ===========================================================================
+
+import pangloss
+
+import os,cPickle
+
+# ============================================================================
+
+class Manifest(object):
+    """
+    NAME
+        Manifest
+
+    PURPOSE
+        Keep a record of which pieces of a long job are finished, and
+        which output files they made, so that a job that is stopped can
+        be restarted without redoing them.
+
+    COMMENTS
+        Each finished piece of work is recorded under a key (eg the
+        name of the lightcone reconstructed), along with the hash of the
+        configuration it was done with, a stamp (size and mtime) of each
+        of its input files, and the md5 hash of each of its output
+        files. A piece of work is done if all of these still match: if
+        the config has changed, an input has been rewritten, or an output
+        is missing or damaged, it has to be done again.
+
+        Settings that the work depends on, but that are not in the
+        config file (like a random seed chosen at the start of the
+        run), can be remembered in the manifest too, so that a resumed
+        run uses the same ones. Forgetting the record forgets them too.
+
+        The manifest is a pickle, plus a journal (the same filename, with
+        .journal added) that each finished piece of work is appended to,
+        so that recording one costs the same however many are recorded
+        already. Reading the manifest back plays the journal onto the
+        pickle, rewrites the pickle (atomically, by writePickle) and
+        starts a new journal; a journal cut short by a crash loses at
+        most the piece being recorded. Only one process should record
+        things in a given manifest.
+
+    INITIALISATION
+        filename      Name of manifest pickle: read in if it exists
+        confighash    Hash of the current configuration, from
+                      Configuration.getHash
+
+    METHODS
+        done(self,key,inputs): is the piece of work called key, with
+            input files named in the list inputs, already done?
+
+        record(self,key,inputs,outputs): note that the piece of work
+            called key, with input and output files named in the lists
+            inputs and outputs, is done
+
+        remember(self,name,value): keep a setting for the rest of the job
+
+        recall(self,name,default=None): a setting remembered earlier, by
+            this run or the one being resumed
+
+        forget(self): clear the record, and start again
+
+        save(self): rewrite the pickle with everything recorded so far,
+            and empty the journal
+
+    BUGS
+
+    AUTHORS
+      This file is part of the Pangloss project, distributed under the
+      GPL v2, by Tom Collett (IoA) and  Phil Marshall (Oxford).
+      Please cite: Collett et al 2013, http://arxiv.org/abs/1303.6564
+
+    HISTORY
+      2026-10-16  started so that Reconstruct runs can resume, Pangloss developers
+    """
+
+# ----------------------------------------------------------------------------
+
+    def __init__(self,filename,confighash):
+
+        self.name = 'Manifest of finished work'
+        self.filename = filename
+        self.journalname = filename+'.journal'
+        self.confighash = confighash
+
+        # A missing or unreadable manifest just means nothing is done yet:
+        try:
+            contents = pangloss.readPickle(filename)
+        except (IOError,EOFError,cPickle.UnpicklingError):
+            contents = {}
+        self.entries = contents.get('entries',{})
+        self.settings = contents.get('settings',{})
+
+        # Play back the work recorded since, and fold it into the pickle.
+        # The journal is only opened when something is next recorded (so
+        # that worker processes forked before then don't share it):
+        self.journal = None
+        self.replay()
+        if os.path.exists(self.journalname): self.save()
+
+        return None
+
+# ----------------------------------------------------------------------------
+
+    def __str__(self):
+        return 'Manifest of %i finished pieces of work, in %s' % (len(self.entries),self.filename)
+
+    def __len__(self):
+        return len(self.entries)
+
+# ----------------------------------------------------------------------------
+
+    def done(self,key,inputs):
+
+        entry = self.entries.get(key)
+        if entry is None: return False
+        if entry['config'] != self.confighash: return False
+
+        for filename,stamp in entry['inputs']:
+            if filename not in inputs: return False
+            if pangloss.stamp(filename) != stamp: return False
+        if len(entry['inputs']) != len(inputs): return False
+
+        for filename,md5 in entry['outputs']:
+            try:
+                if pangloss.md5sum(filename) != md5: return False
+            except IOError:
+                return False
+
+        return True
+
+    def record(self,key,inputs,outputs):
+
+        entry = {'config':self.confighash,
+                 'inputs':[(filename,pangloss.stamp(filename)) for filename in inputs],
+                 'outputs':[(filename,pangloss.md5sum(filename)) for filename in outputs]}
+        self.entries[key] = entry
+        self.append(('entry',key,entry))
+
+        return
+
+    def remember(self,name,value):
+        self.settings[name] = value
+        self.append(('setting',name,value))
+        return
+
+    def recall(self,name,default=None):
+        return self.settings.get(name,default)
+
+    def forget(self):
+        self.entries = {}
+        self.settings = {}
+        self.close()
+        pangloss.rm(self.filename)
+        pangloss.rm(self.journalname)
+        return
+
+    def save(self):
+        contents = {'entries':self.entries,'settings':self.settings}
+        pangloss.writePickle(contents,self.filename)
+        # Everything in the journal is in the pickle now:
+        self.close()
+        pangloss.rm(self.journalname)
+        return
+
+# ----------------------------------------------------------------------------
+# The journal: one pickled (kind,name,value) tuple per record, flushed to
+# disk as soon as it is written.
+
+    def append(self,record):
+        if self.journal is None:
+            self.journal = open(self.journalname,'ab')
+        cPickle.dump(record,self.journal,protocol=2)
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        return
+
+    def replay(self):
+        try:
+            F = open(self.journalname,'rb')
+        except IOError:
+            return
+        while True:
+            # Stop at the end, or at a record that was cut short (which
+            # can fail to unpickle in all sorts of ways):
+            try:
+                kind,name,value = cPickle.load(F)
+            except Exception:
+                break
+            if kind == 'entry':
+                self.entries[name] = value
+            else:
+                self.settings[name] = value
+        F.close()
+        return
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        return
+
+# ============================================================================
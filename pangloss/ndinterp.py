@@ -67,6 +67,17 @@ class ndInterp:
         return self.evaluate(points)
 
 
+    def share(self):
+        """
+        Move the data cube and its spline coefficients into shared memory,
+            so that pickling this model (eg to send it to a worker process)
+            only passes references to them. They become read-only.
+        """
+        import pangloss
+        self.z = pangloss.shareArray(self.z)
+        self.spline = pangloss.shareArray(self.spline)
+
+
     def set_order(self,order):
         from scipy import ndimage
         import scipy
@@ -21,9 +21,14 @@ class PDF(object):
 
     INITIALISATION
         parameters     List of parameter names 
+        dtype          Type of the stored samples [numpy.float64]
         
     METHODS
         append(self,sample): add a sample (or numpy array of samples) to the ensemble
+
+    FUNCTIONS
+        comparePDFs(a,b,percentiles=(16,50,84)): percentile shifts
+            between two sets of samples
     
     BUGS
 
@@ -39,13 +44,13 @@ class PDF(object):
 
 # ----------------------------------------------------------------------------
 
-    def __init__(self,parameters):
+    def __init__(self,parameters,dtype=numpy.float64):
         
         self.name = 'Probability Density Function'
         if type(parameters) != list: parameters = [parameters]
         self.parameters = parameters
         self.Ndim = len(parameters)
-        self.samples = numpy.empty((0,self.Ndim))
+        self.samples = numpy.empty((0,self.Ndim),dtype=dtype)
         self.truth = numpy.empty(self.Ndim)
         self.parstring=", ".join(self.parameters)
         
@@ -57,11 +62,13 @@ class PDF(object):
         return 'Probability density function'
 
 # ----------------------------------------------------------------------------
-# Add one sample to the ensemble:
+# Add one sample to the ensemble, or an array of them (one per row), stored
+# in the type the samples were set up with:
 
     def append(self,sample):
-        assert len(sample) == self.Ndim
-        self.samples = numpy.append(self.samples,[sample],axis=0)
+        samples = numpy.array(sample,ndmin=2).astype(self.samples.dtype)
+        assert samples.shape[1] == self.Ndim
+        self.samples = numpy.append(self.samples,samples,axis=0)
         return 
 
 # ----------------------------------------------------------------------------
@@ -166,6 +173,26 @@ class PDF(object):
                 
         return None
 
+#=============================================================================
+# How different are two sets of samples, eg of Pr(kappah|D) computed in
+# single and double precision? Returns a dictionary holding the percentiles
+# of both, the shifts b-a at each percentile, and the width of a (half its
+# 16-84 percentile range, ie sigma for a Gaussian).
+
+def comparePDFs(a,b,percentiles=(16,50,84)):
+
+    a = numpy.sort(numpy.asarray(a,dtype=numpy.float64).ravel())
+    b = numpy.sort(numpy.asarray(b,dtype=numpy.float64).ravel())
+
+    comparison = {}
+    comparison['percentiles'] = numpy.array(percentiles)
+    comparison['a'] = numpy.percentile(a,percentiles)
+    comparison['b'] = numpy.percentile(b,percentiles)
+    comparison['shift'] = comparison['b'] - comparison['a']
+    comparison['width'] = 0.5*(numpy.percentile(a,84)-numpy.percentile(a,16))
+
+    return comparison
+
 #=============================================================================
 
 if __name__ == '__main__':
@@ -0,0 +1,143 @@
+# ===========================================================================
+
+import pangloss
+
+import os,atexit,tempfile,numpy
+
+# ============================================================================
+
+class SharedArray(numpy.ndarray):
+    """
+    NAME
+        SharedArray
+
+    PURPOSE
+        A read-only numpy array kept in a shared memory segment (a file in
+        /dev/shm), that is pickled by reference: unpickling it, in any
+        process on the same machine, maps the same segment rather than
+        copying the data.
+
+    COMMENTS
+        Big lookup tables (like the SHMR grids) can then be handed to
+        worker processes for free: the worker maps the segment read-only,
+        and every process shares the same physical memory.
+
+        The segment belongs to the process that made it (with
+        shareArray), and is removed when that process exits - so a
+        SharedArray must not be pickled to a file that will outlive it.
+        Write any pickles of an object before sharing its arrays.
+
+        A process that is killed never gets to remove its segments, and
+        they would sit in memory until the machine reboots. So once the
+        worker processes have been forked (and so have the segments
+        mapped already), the maker should call unlinkSharedArrays: the
+        files go, but the memory stays mapped in every process until it
+        exits. Arrays whose segment has gone are pickled by value.
+
+        Slices and arithmetic results are ordinary arrays as far as
+        pickling is concerned: only a whole shared array is pickled by
+        reference.
+
+    INITIALISATION
+        Use shareArray(array) to copy an array into a new segment, and
+        attachSharedArray(filename,dtype,shape) to map an existing one.
+
+    METHODS
+        segment: name of the shared memory file, or None for slices etc
+
+    FUNCTIONS
+        shareArray(array): copy array into a new segment
+
+        attachSharedArray(filename,dtype,shape): map an existing segment
+
+        unlinkSharedArrays(): remove this process's segment files now,
+            leaving them mapped
+
+    BUGS
+        - Processes must share a filesystem (/dev/shm, or the temporary
+          directory where there is no /dev/shm): ie, the same machine.
+
+    AUTHORS
+      This file is part of the Pangloss project, distributed under the
+      GPL v2, by Tom Collett (IoA) and  Phil Marshall (Oxford).
+      Please cite: Collett et al 2013, http://arxiv.org/abs/1303.6564
+
+    HISTORY
+      2026-10-16  started for handing the SHMR and Grid to workers, Pangloss developers
+    """
+
+# ----------------------------------------------------------------------------
+
+    def __array_finalize__(self,obj):
+        # Views and results don't own the segment:
+        self.segment = None
+        return
+
+    def __reduce__(self):
+        if self.segment is not None and os.path.exists(self.segment):
+            return (attachSharedArray,(self.segment,self.dtype.str,self.shape))
+        return numpy.asarray(self).__reduce__()
+
+# ============================================================================
+# Segments made so far, and the processes that made them, so that each
+# can be removed when its maker exits:
+
+segments = []
+
+def sharedMemoryFolder():
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+# ----------------------------------------------------------------------------
+# Copy an array into a new shared memory segment, and return it as a
+# read-only SharedArray:
+
+def shareArray(array):
+
+    array = numpy.ascontiguousarray(array)
+    filename = '%s/pangloss-%i-%i.shm' % (sharedMemoryFolder(),os.getpid(),len(segments))
+    segments.append((os.getpid(),filename))
+
+    if array.size > 0:
+        segment = numpy.memmap(filename,dtype=array.dtype,mode='w+',shape=array.shape)
+        segment[...] = array
+        segment.flush()
+        del segment
+    else:
+        open(filename,'wb').close()
+
+    return attachSharedArray(filename,array.dtype.str,array.shape)
+
+# ----------------------------------------------------------------------------
+# Map an existing segment, read-only:
+
+def attachSharedArray(filename,dtype,shape):
+
+    dtype = numpy.dtype(dtype)
+    if numpy.prod(shape) > 0:
+        values = numpy.memmap(filename,dtype=dtype,mode='r',shape=shape)
+    else:
+        values = numpy.zeros(shape,dtype=dtype)
+        values.flags.writeable = False
+
+    shared = values.view(SharedArray)
+    shared.segment = filename
+
+    return shared
+
+# ----------------------------------------------------------------------------
+# Only the process that made a segment removes it - forked workers
+# inherit this list, but must leave their parent's segments alone. Removing
+# the file doesn't unmap the memory: processes that have it mapped keep it
+# until they exit, and then the system frees it.
+
+def unlinkSharedArrays():
+    for pid,filename in segments:
+        if pid == os.getpid(): pangloss.rm(filename)
+    del segments[:]
+    return
+
+atexit.register(unlinkSharedArrays)
+
+# ============================================================================
@@ -3,7 +3,7 @@
 
 import pangloss
 
-import numpy
+import os,cPickle,hashlib,numpy,scipy
 from scipy import interpolate,optimize
 
 # ============================================================================
@@ -47,6 +47,13 @@ class SHMR(object):
 
         Mstar_to_M200(self,M_Star,redshift):
 
+        getCacheKey(self,HMFfile): hex digest identifying the relation
+            that makeHaloMassFunction(HMFfile) and makeCDFs would make
+
+        share(self): move the gridded models into shared memory, so that
+            worker processes can use them without copying them (pickle
+            the SHMR to a file before doing this, not after)
+
     BUGS
         - Code uses case-sensitive variables in places, and is untested.
 
@@ -264,6 +271,36 @@ class SHMR(object):
         
         return
         
+# ----------------------------------------------------------------------
+# Everything the finished relation depends on: the method, the grid axes,
+# the contents of the halo mass function catalog, and the code that builds
+# and evaluates the grids (this file, ndinterp, numpy and scipy).
+
+    def getCacheKey(self,HMFfile):
+
+        md5 = hashlib.md5()
+        md5.update(repr((self.method,self.nMh,self.nMs,self.nz)))
+        for axis in (self.Mh_axis,self.Ms_axis,self.zed_axis):
+            md5.update(numpy.ascontiguousarray(axis).tostring())
+        md5.update(pangloss.md5sum(HMFfile))
+
+        folder = os.path.dirname(os.path.abspath(__file__))
+        for source in ('shmr.py','ndinterp.py'):
+            md5.update(pangloss.md5sum(folder+'/'+source))
+        md5.update(repr((numpy.__version__,scipy.__version__)))
+
+        return md5.hexdigest()
+
+# ----------------------------------------------------------------------
+# The S2H grid is 251x501x10 doubles, twice over (data and spline): put it,
+# and the H2S grid, in shared memory so that worker processes all use the
+# same copy.
+
+    def share(self):
+        self.S2H_model.share()
+        self.H2S_model.share()
+        return
+
 # ----------------------------------------------------------------------
 # Takes an array of stellar mass and an array of redshifts, and returns 
 # the best fit halo mass of {behroozi}.
@@ -316,6 +353,47 @@ class SHMR(object):
             M_200[i] =(numpy.log10(M_1)+beta*numpy.log10(M_Star[i]/Mstar0)+((M_Star[i]/Mstar0)**delta)/(1.+(M_Star[i]/Mstar0)**-gamma)-0.5)
         return M_200 
 
+# ============================================================================
+# Making the SHMR grids takes a while, so finished relations are kept in
+# folder, in pickles named after their cache key: if anything the relation
+# depends on changes, so does the name, and a new one is made. Each
+# relation is also kept for the rest of this process.
+
+shmrs = {}
+
+def getSHMRCacheName(folder,method,key):
+    return '%s/SHMR_%s_%s.pickle' % (folder,method,key[:16])
+
+def getSHMR(method='Behroozi',HMFfile=None,folder=None):
+
+    shmr = SHMR(method=method)
+    key = shmr.getCacheKey(HMFfile)
+
+    if key in shmrs:
+        return shmrs[key]
+
+    cached = None
+    if folder is not None:
+        filename = getSHMRCacheName(folder,method,key)
+        try:
+            cached = pangloss.readPickle(filename)
+        except (IOError,EOFError,cPickle.UnpicklingError):
+            cached = None
+        if getattr(cached,'cachekey',None) != key: cached = None
+
+    if cached is None:
+        shmr.makeHaloMassFunction(HMFfile)
+        shmr.makeCDFs()
+        shmr.cachekey = key
+        if folder is not None:
+            pangloss.writePickle(shmr,filename)
+    else:
+        shmr = cached
+
+    shmrs[key] = shmr
+
+    return shmr
+
 #=============================================================================
 
 if __name__ == '__main__':
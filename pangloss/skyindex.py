@@ -0,0 +1,271 @@
+# ===========================================================================
+
+import pangloss
+
+import numpy
+
+# ============================================================================
+
+class SkyIndex(object):
+    """
+    NAME
+        SkyIndex
+
+    PURPOSE
+        Sort the galaxies of a large catalog into a grid of cells on the
+        sky, so that the galaxies near a given position can be found
+        without looking at the whole catalog.
+
+    COMMENTS
+        Galaxies are sorted by cell number, counting along nRA first, so
+        each row of cells is a contiguous slice of the sorted index
+        array. A box query then costs one slice per row of cells it
+        overlaps, plus exact comparisons on the candidates found there.
+        Build the index once per catalog, and pass it to every
+        Lightcone drilled from that catalog.
+
+    INITIALISATION
+        x             Galaxy nRA positions (rad)
+        y             Galaxy Dec positions (rad)
+        cellsize      Width of the grid cells (rad): the lightcone
+                      radius is a good choice
+
+    METHODS
+        cell(self,x,y): return cell column and row numbers of positions
+
+        box(self,xc,yc,dx): return catalog row numbers of galaxies with
+            |x-xc| < dx and |y-yc| < dx, in catalog order
+
+    BUGS
+
+    AUTHORS
+      This file is part of the Pangloss project, distributed under the
+      GPL v2, by Tom Collett (IoA) and  Phil Marshall (Oxford).
+      Please cite: Collett et al 2013, http://arxiv.org/abs/1303.6564
+
+    HISTORY
+      2026-10-16  started for drilling many lightcones per catalog, Pangloss developers
+    """
+
+# ----------------------------------------------------------------------------
+
+    def __init__(self,x,y,cellsize):
+
+        self.name = 'Sky index of galaxy positions'
+        self.x = numpy.asarray(x)
+        self.y = numpy.asarray(y)
+        self.N = len(self.x)
+
+        # Catalog limits:
+        self.xmax = self.x.max()
+        self.xmin = self.x.min()
+        self.ymax = self.y.max()
+        self.ymin = self.y.min()
+
+        # Don't let the grid get silly for tiny cells:
+        extent = max(self.xmax-self.xmin,self.ymax-self.ymin)
+        self.cellsize = max(cellsize,extent/4096.0)
+        self.nx = int((self.xmax-self.xmin)/self.cellsize) + 1
+        self.ny = int((self.ymax-self.ymin)/self.cellsize) + 1
+
+        # Sort galaxies by cell, keeping catalog order within each cell:
+        ix,iy = self.cell(self.x,self.y)
+        cells = iy*self.nx + ix
+        self.order = numpy.argsort(cells,kind='mergesort')
+        self.start = numpy.searchsorted(cells[self.order],\
+                                        numpy.arange(self.nx*self.ny+1))
+
+        return None
+
+# ----------------------------------------------------------------------------
+
+    def __str__(self):
+        return 'Sky index of %i galaxies in %i x %i cells' % (self.N,self.nx,self.ny)
+
+# ----------------------------------------------------------------------------
+
+    def cell(self,x,y):
+        ix = numpy.floor((x - self.xmin)/self.cellsize).astype(int)
+        iy = numpy.floor((y - self.ymin)/self.cellsize).astype(int)
+        ix = numpy.clip(ix,0,self.nx-1)
+        iy = numpy.clip(iy,0,self.ny-1)
+        return ix,iy
+
+# ----------------------------------------------------------------------------
+# Row numbers of the galaxies inside a square box, in catalog order:
+
+    def box(self,xc,yc,dx):
+
+        ix0,iy0 = self.cell(xc-dx,yc-dx)
+        ix1,iy1 = self.cell(xc+dx,yc+dx)
+
+        rows = []
+        for iy in range(iy0,iy1+1):
+            first = self.start[iy*self.nx + ix0]
+            last = self.start[iy*self.nx + ix1 + 1]
+            rows.append(self.order[first:last])
+        rows = numpy.concatenate(rows)
+
+        x = self.x[rows]
+        y = self.y[rows]
+        inside = (x > (xc-dx)) & (x < (xc+dx)) & (y > (yc-dx)) & (y < (yc+dx))
+
+        return numpy.sort(rows[inside])
+
+# ============================================================================
+
+class RadialIndex(object):
+    """
+    NAME
+        RadialIndex
+
+    PURPOSE
+        Sort the galaxies of a lightcone by their distance from its
+        centre, keeping their magnitudes alongside, so that the galaxies
+        within any radius, and in any magnitude window, can be counted or
+        selected without looking at the whole table.
+
+    COMMENTS
+        The galaxies within radius R are the first searchsorted(r,R) of
+        the sorted ones. Counts come from a cumulative sum of which sorted
+        galaxies are in each magnitude window, so any number of radii
+        and windows can be counted at once: eg the whole number count
+        vs radius curve of a lightcone, in one call.
+
+        Lightcone.radialIndex(band) makes one of these per band and keeps
+        it until the lightcone's galaxies are next reselected.
+
+    INITIALISATION
+        r             Galaxy distances from the lightcone centre (arcmin)
+        mag           Galaxy magnitudes
+
+    METHODS
+        count(self,radius,cut=[18.5,24.5]): numbers of galaxies with
+            r < radius and cut[0] < mag < cut[1]; radius can be an array,
+            and cut an array of [bright,faint] windows, one per row
+
+        rows(self,radius,cut=[18.5,24.5]): row numbers of those galaxies,
+            in table order
+
+    BUGS
+
+    AUTHORS
+      This file is part of the Pangloss project, distributed under the
+      GPL v2, by Tom Collett (IoA) and  Phil Marshall (Oxford).
+      Please cite: Collett et al 2013, http://arxiv.org/abs/1303.6564
+
+    HISTORY
+      2026-10-16  added for counting galaxies at many radii at once, Pangloss developers
+    """
+
+# ----------------------------------------------------------------------------
+
+    def __init__(self,r,mag):
+
+        self.name = 'Radial index of lightcone galaxies'
+        r = numpy.asarray(r)
+        self.order = numpy.argsort(r,kind='mergesort')
+        self.r = r[self.order]
+        self.mag = numpy.asarray(mag)[self.order]
+        self.N = len(self.r)
+
+        return None
+
+# ----------------------------------------------------------------------------
+
+    def __str__(self):
+        return 'Radial index of %i galaxies' % self.N
+
+# ----------------------------------------------------------------------------
+# Counts have the shape of radius, with an extra first axis if there is
+# more than one magnitude window:
+
+    def count(self,radius,cut=[18.5,24.5]):
+
+        cuts = numpy.array(cut,dtype=float,ndmin=2)
+        inside = (self.mag > cuts[:,0:1]) & (self.mag < cuts[:,1:2])
+        cumulative = numpy.zeros((len(cuts),self.N+1),dtype=int)
+        numpy.cumsum(inside,axis=1,out=cumulative[:,1:])
+
+        # Number of galaxies with r < radius:
+        k = numpy.searchsorted(self.r,radius,side='left')
+        counts = cumulative[:,k]
+
+        if numpy.ndim(cut) == 1: counts = counts[0]
+        return counts
+
+    def rows(self,radius,cut=[18.5,24.5]):
+
+        k = numpy.searchsorted(self.r,radius,side='left')
+        mag = self.mag[:k]
+        inside = (mag > cut[0]) & (mag < cut[1])
+
+        return numpy.sort(self.order[:k][inside])
+
+# ============================================================================
+# Assign galaxies to many lightcones in one sweep over the catalog. The cone
+# centres are indexed, rather than the galaxies: each galaxy then only has
+# to be compared with the cones centred in its own and the 8 neighbouring
+# cells. Galaxies are taken in chunks, to bound the number of candidate
+# pairs held at once.
+#
+# Returns offsets,rows: the catalog row numbers of the galaxies in cone k
+# are rows[offsets[k]:offsets[k+1]], in catalog order. The selection is the
+# same as the square cut and circular trim done in Lightcone.
+
+def assignToCones(x,y,xc,yc,radius,chunksize=1000000):
+
+    x = numpy.asarray(x)
+    y = numpy.asarray(y)
+    Nc = len(xc)
+    if Nc == 0: return numpy.zeros(1,dtype=int),numpy.zeros(0,dtype=int)
+    dx = radius*pangloss.arcmin2rad
+
+    cones = SkyIndex(xc,yc,dx)
+
+    allcones,allrows = [],[]
+    for first in range(0,len(x),chunksize):
+        gx = x[first:first+chunksize]
+        gy = y[first:first+chunksize]
+        ix,iy = cones.cell(gx,gy)
+        lo = numpy.maximum(ix-1,0)
+        hi = numpy.minimum(ix+1,cones.nx-1)
+
+        # Candidate cones come from 3 rows of cells, each a contiguous
+        # slice of the sorted cone index:
+        for dy in (-1,0,1):
+            row = iy + dy
+            ok = (row >= 0) & (row < cones.ny)
+            galaxy = numpy.arange(len(gx))[ok]
+            start = cones.start[row[ok]*cones.nx + lo[ok]]
+            stop = cones.start[row[ok]*cones.nx + hi[ok] + 1]
+            count = stop - start
+            if count.sum() == 0: continue
+
+            galaxy = numpy.repeat(galaxy,count)
+            step = numpy.arange(count.sum()) - numpy.repeat(numpy.cumsum(count)-count,count)
+            cone = cones.order[numpy.repeat(start,count) + step]
+
+            # Square cut, then circular trim, as in Lightcone:
+            px,py = gx[galaxy],gy[galaxy]
+            cx,cy = cones.x[cone],cones.y[cone]
+            inside = (px > (cx-dx)) & (px < (cx+dx)) & (py > (cy-dx)) & (py < (cy+dx))
+            galaxy,cone = galaxy[inside],cone[inside]
+            px = (px[inside] - cx[inside])*pangloss.rad2arcmin
+            py = (py[inside] - cy[inside])*pangloss.rad2arcmin
+            inside = numpy.sqrt(px*px + py*py) < radius
+
+            allcones.append(cone[inside])
+            allrows.append(galaxy[inside] + first)
+
+    if len(allrows) == 0:
+        return numpy.zeros(Nc+1,dtype=int),numpy.zeros(0,dtype=int)
+
+    cone = numpy.concatenate(allcones)
+    rows = numpy.concatenate(allrows)
+    order = numpy.lexsort((rows,cone))
+    offsets = numpy.searchsorted(cone[order],numpy.arange(Nc+1))
+
+    return offsets,rows[order]
+
+# ============================================================================
@@ -0,0 +1,96 @@
+# ===========================================================================
+# Lightcones written to a LightconeArchive (or saved on their own) must
+# read back with the same galaxies and metadata.
+# ===========================================================================
+
+import os,sys
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+import pangloss
+
+import numpy,pytest
+
+# ----------------------------------------------------------------------------
+
+def makeLightcones(rng):
+
+    N = 2000
+    catalog = pangloss.GalaxyTable()
+    catalog.add_column('nRA',rng.uniform(-10,10,N)*pangloss.arcmin2rad)
+    catalog.add_column('Dec',rng.uniform(-10,10,N)*pangloss.arcmin2rad)
+    catalog.add_column('z_obs',rng.uniform(0.05,2.0,N))
+    catalog.add_column('Mhalo_obs',10**rng.uniform(11.0,13.5,N))
+    catalog.add_column('mag',rng.uniform(18.0,24.0,N))
+    catalog.add_column('Type',rng.randint(0,3,N))
+
+    # The last one has no galaxies in it:
+    centres = [(0.0,0.0),(5.0,-3.0),(-7.0,6.0),(50.0,50.0)]
+    lightcones = []
+    for k,(x,y) in enumerate(centres):
+        lc = pangloss.Lightcone(catalog,'simulated',[x*pangloss.arcmin2rad,y*pangloss.arcmin2rad],2.0)
+        lc.kappa_hilbert = 0.01*k
+        lightcones.append(lc)
+
+    return lightcones
+
+def assertSameLightcone(lc,copy):
+
+    assert list(copy.galaxies.keys()) == list(lc.galaxies.keys())
+    for name in lc.galaxies.keys():
+        ours,theirs = numpy.asarray(copy.galaxies[name]),numpy.asarray(lc.galaxies[name])
+        assert ours.dtype == theirs.dtype, name
+        assert numpy.all(ours == theirs), name
+    for key in ['flavor','kappa_hilbert','rmax','xmin','xmax','ymin','ymax']:
+        assert getattr(copy,key) == getattr(lc,key), key
+    assert list(copy.xc) == list(lc.xc)
+
+    return
+
+# ----------------------------------------------------------------------------
+
+@pytest.mark.parametrize('spool',[True,False])
+@pytest.mark.parametrize('memmap',[True,False])
+def test_archive_round_trip(tmpdir,spool,memmap):
+
+    lightcones = makeLightcones(numpy.random.RandomState(11))
+    assert len(lightcones[-1].galaxies) == 0
+
+    filename = os.path.join(str(tmpdir),'test.archive')
+    archive = pangloss.LightconeArchive(filename,mode='w',spool=spool)
+    for lc in lightcones:
+        archive.append(lc)
+    archive.close()
+    assert pangloss.isLightconeArchive(filename)
+    assert [name for name in os.listdir(str(tmpdir))] == ['test.archive']
+
+    archive = pangloss.LightconeArchive(filename,memmap=memmap)
+    assert len(archive) == len(lightcones)
+    for k,lc in enumerate(lightcones):
+        assertSameLightcone(lc,archive.read(k))
+
+    # The header holds no numpy classes:
+    assert isinstance(archive.cones[0]['xc'],list)
+
+def test_save_and_readLightcone(tmpdir):
+
+    lc = makeLightcones(numpy.random.RandomState(12))[1]
+    filename = os.path.join(str(tmpdir),'pointing_1_lightcone.bin')
+    lc.save(filename)
+
+    copy = pangloss.readLightcone(filename)
+    assertSameLightcone(lc,copy)
+
+    # Mapped columns are copied when first written to, not before:
+    copy.writeColumn('z',copy.galaxies.z*2.0)
+    assert numpy.all(pangloss.readLightcone(filename).galaxies.z == lc.galaxies.z)
+
+def test_archive_refuses_other_column_types(tmpdir):
+
+    lightcones = makeLightcones(numpy.random.RandomState(13))
+    archive = pangloss.LightconeArchive(os.path.join(str(tmpdir),'test.archive'),mode='w')
+    archive.append(lightcones[0])
+    lightcones[1].setPrecision(numpy.float32)
+    with pytest.raises(ValueError):
+        archive.append(lightcones[1])
+
+# ============================================================================
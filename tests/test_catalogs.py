@@ -0,0 +1,111 @@
+# ===========================================================================
+# Catalogs read through the binary cache (and in chunks) must come out
+# exactly as atpy reads them, whatever their layout.
+# ===========================================================================
+
+import os,sys
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+import pangloss
+
+import numpy,pytest
+
+# ----------------------------------------------------------------------------
+
+config = """
+ExperimentName: test
+CalibrationCatalogs: %(folder)s/catalog*.txt
+CalibrationKappamaps: None
+ObservedCatalog: %(folder)s/catalog.txt
+CalibrationFolder: %(folder)s/calib
+HMFfile: None
+nRAName: pos_0[rad]
+DecName: pos_1[rad]
+CalibMhaloName: M_Subhalo[M_sol/h]
+CalibRedshiftName: z_spec
+MagName: mag_SDSS_i
+LightconeDepthBand: i
+CatalogColumns: all
+NCalibrationLightcones: 1
+NRealisations: 1
+PhotometricRadius: [1,2]
+PhotometricDepth: [26,26]
+SpectroscopicRadius: [1,2]
+SpectroscopicDepth: [24,23]
+"""
+
+header = ['pos_0[rad]','pos_1[rad]','M_Subhalo[M_sol/h]','z_spec','mag_SDSS_i','Type','Name']
+
+rows = [['-0.00165956','0.00611604','3.27268e+13','0.5759','19.886','1','a'],
+        ['0.00440649','0.00083175','1.47150e+10','1.3254','25.203','0','bb'],
+        ['0.00012345','-0.0031415','nan','0.1100','23.010','2','ccc']]
+
+# Whitespace-separated, as readAsciiChunks reads them itself, and two
+# layouts that only atpy understands:
+
+layouts = {'plain': ' '.join(header)+'\n'+''.join(' '.join(row)+'\n' for row in rows*5),
+           'csv': ','.join(header)+'\n'+''.join(','.join(row)+'\n' for row in rows*5),
+           'commented': '# '+' '.join(header)+'\n'+''.join(' '.join(row)+'\n' for row in rows*5)}
+
+# ----------------------------------------------------------------------------
+
+def readBothWays(tmpdir,layout):
+
+    folder = str(tmpdir)
+    catalog = os.path.join(folder,'catalog.txt')
+    open(catalog,'w').write(layouts[layout])
+    configfile = os.path.join(folder,'test.config')
+    open(configfile,'w').write(config % {'folder':folder})
+    experiment = pangloss.Configuration(configfile)
+
+    experiment.parameters['CatalogCache'] = 'False'
+    reference = pangloss.readCatalog(catalog,experiment)
+
+    experiment.parameters['CatalogCache'] = 'True'
+    made = pangloss.readCatalog(catalog,experiment)
+    cached = pangloss.readCatalog(catalog,experiment)
+    assert os.path.isdir(pangloss.getCatalogCacheName(catalog))
+
+    chunks = list(pangloss.readCatalogChunks(catalog,experiment,chunksize=4,columns=None))
+
+    return reference,[made,cached],chunks
+
+def assertSameColumns(reference,table,names):
+    for name in names:
+        theirs,ours = numpy.asarray(reference[name]),numpy.asarray(table[name])
+        assert ours.dtype == theirs.dtype, (name,ours.dtype,theirs.dtype)
+        same = (ours == theirs)
+        if ours.dtype.kind == 'f':
+            same |= (numpy.isnan(ours) & numpy.isnan(theirs))
+        assert numpy.all(same), name
+    return
+
+# ----------------------------------------------------------------------------
+
+@pytest.mark.parametrize('layout',sorted(layouts.keys()))
+def test_cache_matches_atpy(tmpdir,layout):
+
+    reference,tables,chunks = readBothWays(tmpdir,layout)
+    names = list(reference.keys())
+    assert 'nRA' in names and 'Mhalo_obs' in names
+
+    for table in tables:
+        assert list(table.keys()) == names
+        assertSameColumns(reference,table,names)
+
+    # With every column asked for, chunks keep the magnitude under its own
+    # name as well as 'mag', just as readCatalog does:
+    for chunk in chunks:
+        assert list(chunk.keys()) == names
+    whole = dict((name,numpy.concatenate([numpy.asarray(chunk[name]) for chunk in chunks]))
+                 for name in names)
+    assertSameColumns(reference,whole,names)
+
+def test_chunk_parser_not_used_for_csv(tmpdir):
+
+    for layout,agree in [('plain',True),('commented',True),('csv',False)]:
+        catalog = os.path.join(str(tmpdir),layout+'.txt')
+        open(catalog,'w').write(layouts[layout])
+        assert pangloss.asciiChunksAgree(catalog) == agree, layout
+
+# ============================================================================
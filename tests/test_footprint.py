@@ -0,0 +1,91 @@
+# ===========================================================================
+# The survey footprint flags set by inFootprint must be the ones the old
+# ring by ring set logic in Lightcone.configureForSurvey gave.
+# ===========================================================================
+
+import os,sys
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+import pangloss
+
+import numpy,pytest
+
+# ----------------------------------------------------------------------------
+# The old logic: a galaxy is flagged if any ring holds it, inside the
+# ring's radius and brighter than its depth.
+
+def ringByRing(r,mag,radii,depths):
+
+    identifier = numpy.arange(len(r))
+    flag = numpy.zeros(len(r),dtype=bool)
+    for R,D in zip(radii,depths):
+        goodset = set(identifier[(r < R) & (mag < D)])
+        flag[numpy.array([_ in goodset for _ in identifier],dtype=bool)] = True
+
+    return flag
+
+class Survey(object):
+
+    def __init__(self,PR,PD,SR,SD):
+        self.parameters = {'PhotometricRadius':PR,'PhotometricDepth':PD,
+                           'SpectroscopicRadius':SR,'SpectroscopicDepth':SD,
+                           'LightconeDepthBand':'r'}
+
+def makeLightcone(N=500,seed=7):
+
+    rng = numpy.random.RandomState(seed)
+    catalog = pangloss.GalaxyTable()
+    catalog.add_column('nRA',rng.uniform(-3,3,N)*pangloss.arcmin2rad)
+    catalog.add_column('Dec',rng.uniform(-3,3,N)*pangloss.arcmin2rad)
+    catalog.add_column('z_obs',rng.uniform(0.05,2.0,N))
+    catalog.add_column('Mhalo_obs',10**rng.uniform(11.0,13.5,N))
+    catalog.add_column('mag_SDSS_r',rng.uniform(16.0,26.0,N))
+
+    return pangloss.Lightcone(catalog,'simulated',[0.0,0.0],3.0)
+
+# ----------------------------------------------------------------------------
+
+@pytest.mark.parametrize('radii,depths',[
+    ([2.0],[22.0]),
+    ([0.5,1.0,2.0,3.0],[25.0,24.0,23.0,22.0]),
+    ([3.0,0.5,2.0,1.0],[21.0,25.5,20.0,23.5]),
+    ([1.0,2.0,2.0,1.0],[20.0,24.0,22.0,25.0]),
+    ])
+def test_inFootprint_matches_ring_by_ring(radii,depths):
+
+    rng = numpy.random.RandomState(11)
+    radii,depths = numpy.array(radii),numpy.array(depths)
+
+    # Continuous values, and values sitting exactly on the ring edges:
+    r = numpy.concatenate([rng.uniform(0,4,2000),rng.choice(radii,500)])
+    mag = numpy.concatenate([rng.uniform(18,27,2000),rng.choice(depths,500)])
+
+    assert numpy.all(pangloss.inFootprint(r,mag,radii,depths) == ringByRing(r,mag,radii,depths))
+
+def test_configureForSurvey_matches_ring_by_ring():
+
+    PR,PD = [3.0,1.0,2.0],[22.0,25.0,23.5]
+    SR,SD = [0.5,2.0],[23.0,20.5]
+
+    lc = makeLightcone()
+    r = lc.galaxies.r.copy()
+    mag = lc.galaxies.mag_SDSS_r.copy()
+    lc.configureForSurvey(Survey(PR,PD,SR,SD))
+
+    # Ring radii are scaled by 60, as configureForSurvey has always done:
+    photo = ringByRing(r,mag,numpy.array(PR)*60,PD)
+    assert 0 < photo.sum() < len(photo)
+    assert numpy.all(lc.galaxies.r == r[photo])
+
+    spec = ringByRing(r[photo],mag[photo],numpy.array(SR)*60,SD)
+    assert 0 < spec.sum() < len(spec)
+    assert numpy.all(lc.galaxies.spec_flag == spec)
+
+def test_configureForSurvey_without_footprint():
+
+    lc = makeLightcone()
+    lc.configureForSurvey(Survey([''],[''],[''],['']))
+
+    assert len(lc.galaxies) == 0
+
+# ============================================================================
@@ -0,0 +1,107 @@
+# ===========================================================================
+# Lightcone.makeRealisations must draw the same Pr(kappah|D) as the step by
+# step chain (mimicPhotozError ... combineKappas) that it replaces.
+# ===========================================================================
+
+import os,sys
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+import pangloss
+
+import numpy
+
+# ----------------------------------------------------------------------------
+# A toy stellar mass to halo mass relation, with the same interface as
+# pangloss.SHMR. Each draw pulls the masses back towards the middle of the
+# relation, so a chain of realisations settles down rather than wandering
+# off. The halo masses given to drawMstars, and those drawn by drawMhalos,
+# are kept, to check the chain.
+
+class ToySHMR(object):
+
+    def __init__(self):
+        self.given,self.drawn = [],[]
+
+    def drawMstars(self,Mh,z):
+        self.given.append(numpy.array(Mh))
+        return 10.5 + 0.5*(Mh-12.0) + 0.15*numpy.random.randn(len(Mh))
+
+    def drawMhalos(self,Ms,z,X=None):
+        Mh = 12.0 + 0.5*(Ms-10.5) + 0.2*numpy.random.randn(len(Ms))
+        self.drawn.append(Mh)
+        return Mh
+
+# ----------------------------------------------------------------------------
+
+def makeLightcone(flavor,N=200,zl=0.5,zs=1.4):
+
+    rng = numpy.random.RandomState(42)
+    catalog = pangloss.GalaxyTable()
+    catalog.add_column('nRA',rng.uniform(-2,2,N)*pangloss.arcmin2rad)
+    catalog.add_column('Dec',rng.uniform(-2,2,N)*pangloss.arcmin2rad)
+    catalog.add_column('z_obs',rng.uniform(0.05,zs,N))
+    catalog.add_column('Mhalo_obs',10**rng.uniform(11.0,13.5,N))
+    catalog.add_column('Mstar_obs',rng.uniform(9.5,11.5,N))
+    catalog.add_column('mag',rng.uniform(18.0,24.0,N))
+
+    lc = pangloss.Lightcone(catalog,flavor,[0.0,0.0],2.0)
+    lc.defineSystem(zl,zs)
+    grid = pangloss.Grid(zl,zs,nplanes=100)
+    lc.loadGrid(grid)
+    lc.writeColumn('spec_flag',lc.galaxies.mag < 21.0)
+
+    return lc,grid
+
+def stepByStep(lc,grid,shmr,Ns):
+
+    kappas = numpy.zeros(Ns)
+    for j in range(Ns):
+        lc.mimicPhotozError(sigma=0.1)
+        lc.snapToGrid(grid)
+        if lc.flavor == 'simulated': lc.drawMstars(shmr)
+        lc.mimicMstarError(sigmaP=0.45,sigmaS=0.15)
+        lc.drawMhalos(shmr)
+        lc.drawConcentrations(errors=True)
+        lc.makeKappas(truncationscale=10)
+        kappas[j] = lc.combineKappas()
+
+    return kappas
+
+# ----------------------------------------------------------------------------
+
+def test_batched_matches_step_by_step():
+
+    Ns = 400
+    for flavor in ['simulated','real']:
+
+        lc,grid = makeLightcone(flavor)
+        numpy.random.seed(1)
+        batched = lc.makeRealisations(Ns,grid,ToySHMR(),blocksize=20000)['kappa_add']
+
+        lc,grid = makeLightcone(flavor)
+        numpy.random.seed(2)
+        stepped = stepByStep(lc,grid,ToySHMR(),Ns)
+
+        assert numpy.all(numpy.isfinite(batched)), flavor
+        error = numpy.sqrt((batched.var()+stepped.var())/Ns)
+        assert abs(batched.mean()-stepped.mean()) < 5*error, flavor
+        assert abs(numpy.median(batched)-numpy.median(stepped)) < 6*error, flavor
+        assert 0.8 < batched.std()/stepped.std() < 1.25, flavor
+
+def test_batched_chains_halo_masses():
+
+    # Each realisation's mock stellar masses come from the halo masses of
+    # the realisation before, across blocks too, as in the step by step
+    # chain:
+    lc,grid = makeLightcone('simulated')
+    Mh = lc.galaxies.Mh.copy()
+    shmr = ToySHMR()
+    numpy.random.seed(3)
+    lc.makeRealisations(5,grid,shmr,blocksize=2*len(lc.galaxies))
+
+    assert len(shmr.given) == 5
+    assert numpy.all(shmr.given[0] == Mh)
+    for j in range(1,5):
+        assert numpy.all(shmr.given[j] == shmr.drawn[j-1])
+
+# ============================================================================
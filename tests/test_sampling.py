@@ -0,0 +1,58 @@
+# ===========================================================================
+# Drill's sky sampling: sightlines stay inside the catalog, away from its
+# edges, are the same for the same seed, and (for 'poisson') are never
+# closer than the separation asked for.
+# ===========================================================================
+
+import os,sys
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+import pangloss
+import Drill
+
+import numpy,pytest
+
+# ----------------------------------------------------------------------------
+
+corners = {'nRA':numpy.array([0.0,60.0])*pangloss.arcmin2rad,
+           'Dec':numpy.array([0.0,40.0])*pangloss.arcmin2rad}
+
+def closest(x,y):
+    d2 = (x[:,None]-x[None,:])**2 + (y[:,None]-y[None,:])**2
+    d2[numpy.diag_indices(len(x))] = numpy.inf
+    return numpy.sqrt(d2.min())
+
+# ----------------------------------------------------------------------------
+
+def test_poisson_disk_separation():
+
+    dmin = 2.0*pangloss.arcmin2rad
+    for seed in range(5):
+        x,y = Drill.poisson_disk(0.0,0.1,0.0,0.05,150,dmin,numpy.random.RandomState(seed))
+        assert len(x) == 150
+        assert numpy.all((x >= 0.0) & (x <= 0.1) & (y >= 0.0) & (y <= 0.05))
+        assert closest(x,y) >= dmin
+
+def test_poisson_disk_too_crowded():
+
+    dmin = 10.0*pangloss.arcmin2rad
+    with pytest.raises(ValueError):
+        Drill.poisson_disk(0.0,dmin,0.0,dmin,50,dmin,numpy.random.RandomState(0),patience=5)
+
+@pytest.mark.parametrize('method',['random','grid','stratified','poisson'])
+def test_sample_sky(method):
+
+    Rc = 2.0
+    x,y = Drill.sample_sky(corners,Rc,100,method=method,rng=numpy.random.RandomState([1,2]))
+    again = Drill.sample_sky(corners,Rc,100,method=method,rng=numpy.random.RandomState([1,2]))
+    assert numpy.all(x == again[0]) and numpy.all(y == again[1])
+
+    Rcrad = Rc*pangloss.arcmin2rad
+    assert len(x) == 100
+    assert numpy.all((x >= Rcrad) & (x <= 60.0*pangloss.arcmin2rad-Rcrad))
+    assert numpy.all((y >= Rcrad) & (y <= 40.0*pangloss.arcmin2rad-Rcrad))
+    if method == 'poisson':
+        # By default, far enough apart that the cones don't overlap:
+        assert closest(x,y) >= 2.0*Rcrad
+
+# ============================================================================
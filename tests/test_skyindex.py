@@ -0,0 +1,72 @@
+# ===========================================================================
+# assignToCones must put each galaxy in exactly the lightcones that
+# Lightcone itself would drill it into, from the whole catalog - empty
+# cones included.
+# ===========================================================================
+
+import os,sys
+
+sys.path.insert(0,os.path.join(os.path.dirname(__file__),'..'))
+import pangloss
+
+import numpy
+
+# ----------------------------------------------------------------------------
+
+def makeCatalog(N,rng,width=20.0):
+
+    catalog = pangloss.GalaxyTable()
+    catalog.add_column('nRA',rng.uniform(-width,width,N)*pangloss.arcmin2rad)
+    catalog.add_column('Dec',rng.uniform(-width,width,N)*pangloss.arcmin2rad)
+    catalog.add_column('z_obs',rng.uniform(0.05,2.0,N))
+    catalog.add_column('Mhalo_obs',10**rng.uniform(11.0,13.5,N))
+    catalog.add_column('mag',rng.uniform(18.0,24.0,N))
+    catalog.add_column('id',numpy.arange(N))
+
+    return catalog
+
+# ----------------------------------------------------------------------------
+
+def test_assignToCones_matches_lightcones():
+
+    rng = numpy.random.RandomState(7)
+    Rc = 2.0
+    catalog = makeCatalog(5000,rng)
+
+    # Cones all over the catalog, some hanging off its edges, and two far
+    # away from any galaxy:
+    xc = rng.uniform(-22.0,22.0,40)*pangloss.arcmin2rad
+    yc = rng.uniform(-22.0,22.0,40)*pangloss.arcmin2rad
+    xc = numpy.append(xc,[100.0*pangloss.arcmin2rad,-100.0*pangloss.arcmin2rad])
+    yc = numpy.append(yc,[0.0,100.0*pangloss.arcmin2rad])
+
+    # Small chunks, so that galaxies are assigned over several of them:
+    offsets,members = pangloss.assignToCones(catalog['nRA'],catalog['Dec'],xc,yc,Rc,chunksize=700)
+    assert len(offsets) == len(xc)+1
+
+    index = pangloss.SkyIndex(catalog['nRA'],catalog['Dec'],Rc*pangloss.arcmin2rad)
+
+    for k in range(len(xc)):
+        rows = members[offsets[k]:offsets[k+1]]
+        assert numpy.all(numpy.diff(rows) > 0), k
+
+        whole = pangloss.Lightcone(catalog,'simulated',[xc[k],yc[k]],Rc)
+        indexed = pangloss.Lightcone(catalog,'simulated',[xc[k],yc[k]],Rc,index=index)
+        assigned = pangloss.Lightcone(catalog,'simulated',[xc[k],yc[k]],Rc,index=index,rows=rows)
+
+        expected = numpy.sort(whole.galaxies.id)
+        assert numpy.all(catalog['id'][rows] == expected), k
+        assert numpy.all(numpy.sort(indexed.galaxies.id) == expected), k
+        assert numpy.all(numpy.sort(assigned.galaxies.id) == expected), k
+
+    # The far away cones are empty:
+    assert offsets[-1] == offsets[-2] == offsets[-3]
+
+def test_assignToCones_no_cones():
+
+    rng = numpy.random.RandomState(8)
+    catalog = makeCatalog(100,rng)
+    offsets,members = pangloss.assignToCones(catalog['nRA'],catalog['Dec'],[],[],2.0)
+    assert list(offsets) == [0] and len(members) == 0
+
+# ============================================================================